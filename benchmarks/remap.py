@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+remap
+
+Benchmark of remapping with float maps against maps compiled to fixed point by
+gore2.compile_maps, for the maps of each stage of the pipeline: the time of a
+remap with each, the time to compile the maps, their size, and the largest
+difference between the images they produce.
+
+    python remap.py                     the example image at full size
+    python remap.py --image IMAGE       another image
+    python remap.py --threads 1         with OpenCV limited to one thread
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "gore"))
+import gore2
+
+
+def best_time(function, repeats):
+    """
+    best_time:      return the best time of several calls to a function
+
+    function:       function to call, without arguments (callable)
+    repeats:        number of calls (integer)
+
+    returns:        best time (seconds)
+    """
+
+    best = None
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        function()
+        toc = time.perf_counter()
+        best = toc - tic if best is None else min(best, toc - tic)
+
+    return best
+
+
+def stages(im, alpha_max, num_gores, phi_no_cut):
+    """
+    stages:         return the source image and float maps of each stage of
+                    the pipeline, as they are used by make_rotary
+
+    im:             fundus image (ndarray)
+    alpha_max:      angular size of the image from the centre (radians)
+    num_gores:      number of gores (integer)
+    phi_no_cut:     angle of the no-cut zone (radians)
+
+    returns:        list of (name, source image, x map, y map)
+    """
+
+    ht, wd = im.shape[:2]
+    alpha = alpha_max - gore2.deg2rad(1.0)
+    fundus_equi, lammax, phimax = gore2.equi(im, alpha_max)
+    swapped = gore2.swap_resized(fundus_equi, phimax, lammax)
+    h, w = swapped.shape[:2]
+    equatorial = gore2.make_equatorial(swapped, num_gores)
+    composite = gore2.composite_maps(ht, wd, alpha_max, num_gores, phi_no_cut)
+
+    return [("equi", im) + gore2.equi_maps(ht, wd, alpha),
+            ("swap", fundus_equi) + gore2.swap_maps(h, w // 2, phimax, lammax),
+            ("equatorial", swapped) + gore2.equatorial_maps(h, w, num_gores),
+            ("polar", equatorial) + gore2.polar_maps(h, w, num_gores),
+            ("polecap", fundus_equi) + gore2.polecap_maps(h, w // 2, num_gores, lammax, phimax, phi_no_cut)[:2],
+            ("composite", gore2.cv2.cvtColor(im, gore2.cv2.COLOR_RGB2RGBA)) + composite[:2]]
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark remapping with float and compiled maps.")
+    parser.add_argument("--image", default = os.path.join(here, "..", "img", "img1.jpg"), help = "fundus image")
+    parser.add_argument("--repeats", type = int, default = 5, help = "number of runs, of which the best is taken")
+    parser.add_argument("--threads", type = int, default = None, help = "number of OpenCV threads (default: OpenCV's own)")
+    parser.add_argument("--json", default = None, help = "also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    cv2 = gore2.cv2
+    if args.threads is not None:
+        cv2.setNumThreads(args.threads)
+
+    im = gore2.image_from_path(args.image)
+    results = []
+    print("{0:12} {1:>10} {2:>10} {3:>8} {4:>10} {5:>10} {6:>10}".format(
+          "stage", "float (s)", "fixed (s)", "speedup", "compile (s)", "MB saved", "max error"))
+    for name, src, x_src, y_src in stages(im, gore2.deg2rad(50), 12, gore2.deg2rad(10)):
+        xy, table = gore2.compile_maps(x_src, y_src)
+        remap = lambda maps : cv2.remap(src, *maps, cv2.INTER_LINEAR, borderMode = cv2.BORDER_CONSTANT)
+        result = {"stage" : name,
+                  "pixels" : x_src.size,
+                  "float_seconds" : best_time(lambda : remap((x_src, y_src)), args.repeats),
+                  "fixed_seconds" : best_time(lambda : remap((xy, table)), args.repeats),
+                  "compile_seconds" : best_time(lambda : gore2.compile_maps(x_src, y_src), args.repeats),
+                  "float_bytes" : x_src.nbytes + y_src.nbytes,
+                  "fixed_bytes" : xy.nbytes + table.nbytes,
+                  "max_error" : int(np.abs(remap((x_src, y_src)).astype(int) - remap((xy, table))).max())}
+        results.append(result)
+        print("{stage:12} {float_seconds:10.4f} {fixed_seconds:10.4f} {0:8.2f} {compile_seconds:10.4f} {1:10.1f} {max_error:10d}".format(
+              result["float_seconds"] / result["fixed_seconds"],
+              (result["float_bytes"] - result["fixed_bytes"]) / 1e6, **result))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent = 2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+stages
+
+Benchmark of each stage of the pipeline (equi, swap, make_equatorial for each
+projection, make_polar and polecap) and of the whole of make_rotary_adjusted,
+over a range of input sizes, numbers of gores and qualities, for the example
+images and for synthetic fundus images. Each case is timed cold (with the map
+cache emptied, so including the building of its maps) and warm (the best of
+several calls with the maps cached). The warm times are compared with a saved
+baseline, failing if any case has regressed.
+
+    python stages.py                    compare with the baseline
+    python stages.py --save             save the result as the baseline
+    python stages.py --quick            a small subset of the cases
+    python stages.py --sizes 512 1024 --stages equi swap
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "gore"))
+import gore2
+
+
+"""
+The full sweep, and the subset run by --quick
+"""
+SIZES = (512, 1024, 2048, 4096, 8192)
+GORES = (3, 6, 12, 24)
+QUALITIES = (10, 25, 50, 100)
+QUICK = dict(sizes = (512, 1024), gores = (6, 12), qualities = (25, 100))
+
+STAGES = ("equi", "swap", "equatorial", "polar", "polecap", "rotary")
+
+"""
+Parameters of the pipeline that are not swept (full angles, in degrees)
+"""
+ALPHA_MAX = 100
+PHI_NO_CUT = 20
+
+
+def best_time(function, repeats):
+    """
+    best_time:      return the best time of several calls to a function
+
+    function:       function to call, without arguments (callable)
+    repeats:        number of calls (integer)
+
+    returns:        best time (seconds)
+    """
+
+    best = None
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        function()
+        toc = time.perf_counter()
+        best = toc - tic if best is None else min(best, toc - tic)
+
+    return best
+
+
+def synthetic_fundus(size, seed = 0):
+    """
+    synthetic_fundus:   return a procedurally generated fundus image: an
+                        orange field darkening towards its circular edge, with
+                        a darker macula, a bright optic disc, vessels branching
+                        from the disc and a fine texture, on a black background
+
+    size:               width and height of the image (pixels)
+    seed:               seed of the random vessels and texture (integer)
+
+    returns:            RGB image (ndarray)
+    """
+
+    cv2 = gore2.cv2
+    rng = np.random.default_rng(seed)
+    y, x = np.ogrid[-1 : 1 : size * 1j, -1 : 1 : size * 1j]
+    r2 = (x * x + y * y).astype(np.float32)
+
+    # the retina, vignetted towards the edge of the field
+    shade = np.clip(1 - 0.5 * r2, 0, 1)
+    macula = 1 - 0.35 * np.exp(-r2 / 0.02)
+    im = np.empty((size, size, 3), dtype = np.float32)
+    for channel, (scale, offset) in enumerate(((190, 40), (85, 20), (35, 5))):
+        im[..., channel] = shade * macula * scale + offset
+
+    # the vessels, as random walks out of the optic disc
+    disc = np.array([0.68, 0.5]) * size
+    vessels = np.zeros((size, size), dtype = np.uint8)
+    for angle in rng.uniform(0, 2 * np.pi, 14):
+        point, points = disc.copy(), [disc.copy()]
+        for _ in range(60):
+            angle += rng.normal(0, 0.15)
+            point = point + size / 90 * np.array([np.cos(angle), np.sin(angle)])
+            points.append(point)
+        cv2.polylines(vessels, [np.round(points).astype(np.int32)], False, 255,
+                      thickness = max(1, int(size * rng.uniform(0.002, 0.008))), lineType = cv2.LINE_AA)
+    im *= 1 - 0.45 * (vessels[..., np.newaxis] / np.float32(255))
+
+    # the optic disc, over the vessels
+    d2 = ((x - disc[0] / size * 2 + 1) ** 2 + (y - disc[1] / size * 2 + 1) ** 2).astype(np.float32)
+    glow = np.exp(-d2 / 0.006)[..., np.newaxis]
+    im = im * (1 - glow) + np.array([250, 225, 150], dtype = np.float32) * glow
+
+    im += rng.normal(0, 3, im.shape[:2])[..., np.newaxis].astype(np.float32)
+    im[r2 > 0.92] = 0
+
+    return np.clip(im, 0, 255).astype(np.uint8)
+
+
+def input_images(names, size):
+    """
+    input_images:   yield each input image, resized to size x size
+
+    names:          names of the images: those of the files in img/ (without
+                    their extension) or "synthetic" (list of strings)
+    size:           width and height of the images (pixels)
+
+    yields:         (name, image (ndarray))
+    """
+
+    cv2 = gore2.cv2
+    for name in names:
+        if name == "synthetic":
+            yield name, synthetic_fundus(size)
+            continue
+        path, = glob.glob(os.path.join(here, "..", "img", name + ".*"))
+        im = gore2.image_from_path(path)
+        interpolation = cv2.INTER_AREA if size < max(im.shape[:2]) else cv2.INTER_CUBIC
+        yield name, cv2.resize(im, (size, size), interpolation = interpolation)
+
+
+def cases(im, stages, gores, qualities):
+    """
+    cases:          return the cases to time for an image, each calling one
+                    stage with the input it has within make_rotary_adjusted
+
+    im:             input image (ndarray)
+    stages:         stages to time (list of strings, from STAGES)
+    gores:          numbers of gores (list of integers)
+    qualities:      qualities of make_rotary_adjusted (list of percentages)
+
+    returns:        list of (stage, parameters (dict), function (callable))
+    """
+
+    alpha_max = gore2.deg2rad(ALPHA_MAX) / 2
+    phi_no_cut = gore2.deg2rad(PHI_NO_CUT) / 2
+    rgb = gore2.rgb_with_background(im, (0, 0, 0, 0))
+
+    # the intermediate images are made once, outside the timing
+    fundus_equi, lammax, phimax = gore2.equi(rgb, alpha_max)
+    swapped = gore2.swap_resized(fundus_equi, phimax, lammax)
+
+    result = []
+    if "equi" in stages:
+        result.append(("equi", {}, lambda : gore2.equi(rgb, alpha_max)))
+    if "swap" in stages:
+        result.append(("swap", {}, lambda : gore2.swap(fundus_equi, phi_extent = phimax, lam_extent = lammax)))
+    for num_gores in gores:
+        if "equatorial" in stages:
+            for projection in gore2.Projection:
+                result.append(("equatorial", dict(num_gores = num_gores, projection = projection.name),
+                               lambda n = num_gores, p = projection : gore2.make_equatorial(swapped, n, projection = p)))
+        if "polar" in stages:
+            result.append(("polar", dict(num_gores = num_gores),
+                           lambda n = num_gores : gore2.make_polar(swapped, n)))
+        if "polecap" in stages:
+            result.append(("polecap", dict(num_gores = num_gores),
+                           lambda n = num_gores : gore2.polecap_from_equi(fundus_equi, n, lammax, phimax, phi_no_cut)))
+        if "rotary" in stages:
+            for quality in qualities:
+                result.append(("rotary", dict(num_gores = num_gores, quality = quality),
+                               lambda n = num_gores, q = quality : gore2.make_rotary_adjusted(
+                                   None, alpha_max, n, phi_no_cut, 0, q, im = im)))
+
+    return result
+
+
+def case_name(result):
+    """
+    case_name:      return the name by which a result is compared with the
+                    baseline
+
+    result:         result of one case (dict)
+
+    returns:        name (string)
+    """
+
+    parts = [result["stage"], result["image"], "{0}x{0}".format(result["size"])]
+    for key in ("projection", "num_gores", "quality"):
+        if key in result:
+            parts.append("{0}={1}".format(key, result[key]))
+
+    return " ".join(parts)
+
+
+def run(images, sizes, stages, gores, qualities, repeats):
+    """
+    run:            time every case, printing each result as it is measured
+
+    images:         names of the input images (list of strings)
+    sizes:          input sizes (list of pixels)
+
+    remaining arguments are as cases and best_time
+
+    returns:        results (list of dict)
+    """
+
+    results = []
+    for size in sizes:
+        for name, im in input_images(images, size):
+            for stage, parameters, function in cases(im, stages, gores, qualities):
+                gore2.map_cache.clear()
+                gore2.buffer_pool.clear()
+                result = dict(stage = stage, image = name, size = size, **parameters)
+                result["cold_seconds"] = best_time(function, 1)
+                result["warm_seconds"] = best_time(function, repeats)
+                result["case"] = case_name(result)
+                results.append(result)
+                print("{case:64} {cold_seconds:10.4f} {warm_seconds:10.4f}".format(**result), flush = True)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    compare:        compare results with a baseline, printing the ratio of
+                    each warm time to its baseline
+
+    results:        results (list of dict)
+    baseline:       baseline results (list of dict)
+    tolerance:      allowed fractional regression (float)
+
+    returns:        failures (list of strings)
+    """
+
+    before = {result["case"] : result for result in baseline}
+    failures = []
+    print()
+    print("{0:64} {1:>10} {2:>10} {3:>8}".format("case", "base (s)", "warm (s)", "ratio"))
+    for result in results:
+        old = before.get(result["case"])
+        if old is None:
+            print("{case:64} {0:>10} {warm_seconds:10.4f}".format("-", **result))
+            continue
+        ratio = result["warm_seconds"] / old["warm_seconds"]
+        print("{case:64} {0:10.4f} {warm_seconds:10.4f} {1:8.2f}".format(old["warm_seconds"], ratio, **result))
+        if ratio > 1 + tolerance:
+            failures.append("{0} regressed: {1:.4f}s against {2:.4f}s".format(result["case"], result["warm_seconds"], 
+                                                                           old["warm_seconds"]))
+
+    return failures
+
+
+def main(argv = None):
+    samples = sorted(os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(here, "..", "img", "*")))
+
+    parser = argparse.ArgumentParser(description = "Benchmark each stage of the gore pipeline.")
+    parser.add_argument("--baseline", default = os.path.join(here, "stages_baseline.json"), help = "baseline file")
+    parser.add_argument("--save", action = "store_true", help = "save the result as the baseline")
+    parser.add_argument("--json", default = None, help = "also write the results to this JSON file")
+    parser.add_argument("--quick", action = "store_true", help = "run a small subset of the sizes, gores and qualities")
+    parser.add_argument("--images", nargs = "+", default = samples + ["synthetic"], choices = samples + ["synthetic"],
+                        help = "input images")
+    parser.add_argument("--sizes", nargs = "+", type = int, default = None, help = "input sizes (pixels)")
+    parser.add_argument("--gores", nargs = "+", type = int, default = None, help = "numbers of gores")
+    parser.add_argument("--qualities", nargs = "+", type = int, default = None, help = "qualities (percent)")
+    parser.add_argument("--stages", nargs = "+", default = STAGES, choices = STAGES, help = "stages to time")
+    parser.add_argument("--repeats", type = int, default = 3, help = "number of warm runs, of which the best is taken")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "allowed fractional regression")
+    parser.add_argument("--threads", type = int, default = None, help = "number of OpenCV threads (default: OpenCV's own)")
+    parser.add_argument("--numexpr", action = "store_true", help = "evaluate the projection formulas with numexpr")
+    args = parser.parse_args(argv)
+
+    defaults = QUICK if args.quick else dict(sizes = SIZES, gores = GORES, qualities = QUALITIES)
+    sizes = args.sizes or defaults["sizes"]
+    gores = args.gores or defaults["gores"]
+    qualities = args.qualities or defaults["qualities"]
+
+    if args.threads is not None:
+        gore2.cv2.setNumThreads(args.threads)
+    if args.numexpr and not gore2.use_numexpr():
+        parser.error("numexpr is not installed")
+
+    print("{0:64} {1:>10} {2:>10}".format("case", "cold (s)", "warm (s)"))
+    results = run(args.images, sizes, args.stages, gores, qualities, args.repeats)
+    output = {"machine" : dict(platform = platform.platform(), processor = platform.processor(), cpus = os.cpu_count(),
+                               python = platform.python_version(), numpy = np.__version__,
+                               opencv = gore2.cv2.__version__, 
+                               numexpr = gore2.numexpr.__version__ if gore2.numexpr is not None else None),
+              "results" : results}
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent = 2)
+
+    failures = []
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(output, f, indent = 2)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failures = compare(results, baseline["results"], args.tolerance)
+
+    for failure in failures:
+        print("FAIL", failure)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
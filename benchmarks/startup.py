@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+startup
+
+Benchmark of startup time: the time to import gore2 (from python -X importtime)
+and the time for the application to show its first window. The result is
+compared with a saved baseline, failing if either has regressed.
+
+    python startup.py            compare with the baseline
+    python startup.py --save     save the result as the baseline
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+gore_dir = os.path.join(here, "..", "gore")
+qt_dir = os.path.join(here, "..", "qt")
+
+
+"""
+Modules that must not be loaded by importing gore2
+"""
+DEFERRED = ("cv2", "PIL.Image", "scipy.ndimage", "PyQt5", "numexpr")
+
+
+def import_time(repeats):
+    """
+    import_time:    return the best cumulative time to import gore2 in a fresh
+                    interpreter, as reported by python -X importtime
+
+    repeats:        number of interpreters to start (integer)
+
+    returns:        import time (seconds)
+    """
+
+    best = None
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import gore2"],
+                                cwd = gore_dir, capture_output = True, text = True, check = True)
+        for line in result.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == "gore2":
+                microseconds = int(fields[1])
+        best = microseconds if best is None else min(best, microseconds)
+
+    return best / 1e6
+
+
+def loaded_modules():
+    """
+    loaded_modules: return which of the DEFERRED modules are loaded by
+                    importing gore2
+
+    returns:        names of loaded modules (list of strings)
+    """
+
+    check = ("import sys, gore2\n"
+             "print(','.join(name for name in {0!r} if name in sys.modules))").format(DEFERRED)
+    result = subprocess.run([sys.executable, "-c", check], cwd = gore_dir, capture_output = True, text = True, check = True)
+
+    return [name for name in result.stdout.strip().split(",") if name]
+
+
+def window_time(repeats):
+    """
+    window_time:    return the best time from starting the application to its
+                    first window being shown
+
+    repeats:        number of times to start the application (integer)
+
+    returns:        time to first window (seconds), or None if the application
+                    cannot be started
+    """
+
+    env = dict(os.environ, GORE_EXIT_WHEN_READY = "1")
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+    best = None
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        result = subprocess.run([sys.executable, "app.py"], cwd = qt_dir, env = env, capture_output = True, text = True)
+        toc = time.perf_counter()
+        if result.returncode != 0:
+            print(result.stderr.strip().splitlines()[-1], file = sys.stderr)
+            return None
+        best = toc - tic if best is None else min(best, toc - tic)
+
+    return best
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the startup time of gore2 and the application.")
+    parser.add_argument("--baseline", default = os.path.join(here, "startup_baseline.json"), help = "baseline file")
+    parser.add_argument("--save", action = "store_true", help = "save the result as the baseline")
+    parser.add_argument("--repeats", type = int, default = 5, help = "number of runs, of which the best is taken")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "allowed fractional regression")
+    args = parser.parse_args(argv)
+
+    result = {"import_gore2" : import_time(args.repeats), "first_window" : window_time(args.repeats)}
+    print(json.dumps(result, indent = 2))
+
+    failures = ["import gore2 loads {}".format(name) for name in loaded_modules()]
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(result, f, indent = 2)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for name, value in result.items():
+            if value is not None and baseline.get(name) is not None and value > baseline[name] * (1 + args.tolerance):
+                failures.append("{0} regressed: {1:.3f}s against {2:.3f}s".format(name, value, baseline[name]))
+
+    for failure in failures:
+        print("FAIL", failure)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
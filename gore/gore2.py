@@ -7,13 +7,126 @@ Created on Wed Nov  3 19:21:00 2021
 
 @author: swm
 """
-from PIL import Image
 import numpy as np
 import math as mt
-import cv2
-from scipy import ndimage
-from PyQt5.QtCore import QThread, pyqtBoundSignal
 from enum import Enum
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import importlib.util
+import threading
+import time
+import struct
+import zlib
+import sys
+import os
+
+
+class LazyModule:
+    """
+    LazyModule:     a module that is only imported when one of its attributes
+                    is first used, so that importing gore2 stays fast. The 
+                    import is made under a lock, so that threads first using
+                    the module at the same time all wait for the whole of it
+                    (which importlib.util.LazyLoader does not do before 
+                    Python 3.12)
+    """
+    
+    lock = threading.RLock()
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+    
+    def __repr__(self):
+        return "<deferred module {!r}>".format(self._name) if self._module is None else repr(self._module)
+    
+    def _load(self):
+        """
+        _load:      import the module, if no other thread has done so yet
+        
+        returns:    module
+        """
+        
+        if self._module is None:
+            with LazyModule.lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        
+        return self._module
+
+
+def lazy_import(name):
+    """
+    lazy_import:    import a module that is only loaded when one of its 
+                    attributes is first used, so that importing gore2 stays 
+                    fast
+    
+    name:           full name of the module (string)
+    
+    returns:        module, or LazyModule if it is not loaded yet
+    """
+    
+    if name in sys.modules:
+        return sys.modules[name]
+    
+    return LazyModule(name)
+
+
+"""
+heavy imports, deferred until first used
+"""
+cv2 = lazy_import("cv2")
+Image = lazy_import("PIL.Image")
+ndimage = lazy_import("scipy.ndimage")
+
+
+"""
+optional backend, evaluating each projection formula as a single fused, 
+multi-threaded expression with no intermediate arrays (see use_numexpr), or 
+None to use numpy alone
+"""
+numexpr = None
+
+
+def use_numexpr(enable = True):
+    """
+    use_numexpr:    choose whether the projection formulas of swap and 
+                    make_equatorial (and so of the composite maps) are 
+                    evaluated by numexpr, if it is installed, rather than by
+                    numpy alone; either gives the same maps to within float32 
+                    rounding. numexpr needs no intermediate arrays and uses 
+                    every core, but its float32 trigonometric functions are 
+                    much slower than numpy's unless it is built with Intel's
+                    VML, so it is not used by default: compare the two with
+                    benchmarks/stages.py --numexpr. Maps already in map_cache
+                    are kept.
+    
+    enable:         whether to use numexpr (boolean)
+    
+    returns:        whether numexpr is used (boolean)
+    """
+    
+    global numexpr
+    
+    numexpr = None
+    if enable and importlib.util.find_spec("numexpr") is not None:
+        numexpr = lazy_import("numexpr")
+    
+    return numexpr is not None
+
+
+def preload():
+    """
+    preload:    load the deferred imports now, e.g. once an application has 
+                started, so that the first calculation does not wait for them
+    """
+    
+    for module in (cv2, Image):
+        if isinstance(module, LazyModule):
+            module._load()
 
 
 """
@@ -33,6 +146,12 @@ class Projection(Enum):
     ORTHOGRAPHIC = 2
     
     
+class Mode(Enum):
+    STAGED = 0
+    COMPOSITE = 1
+    TILED = 2
+    
+    
 class Progress(Enum):
     EQUI = 0
     SWAP = 1
@@ -40,27 +159,722 @@ class Progress(Enum):
     POLECAP = 3
 
 
+class CancelToken:
+    """
+    CancelToken:    a flag by which one thread can cancel a calculation running
+                    on another: the calculation checks it between stages, and 
+                    between the strips, bands or gores within a stage
+    """
+    
+    def __init__(self):
+        self.event = threading.Event()
+    
+    def cancel(self):
+        """
+        cancel:     request that the calculation stops
+        """
+        
+        self.event.set()
+    
+    def cancelled(self):
+        """
+        cancelled:  return whether the calculation has been cancelled
+        
+        returns:    boolean
+        """
+        
+        return self.event.is_set()
+
+
+def is_cancelled(cancel):
+    """
+    is_cancelled:   return whether a calculation has been cancelled
+    
+    cancel:         cancellation token (CancelToken, or None if the calculation
+                    cannot be cancelled)
+    
+    returns:        boolean
+    """
+    
+    return cancel is not None and cancel.cancelled()
+
+
+def report(progress, stage):
+    """
+    report:         report the progress of a calculation
+    
+    progress:       function called with the value of each stage as it starts
+                    (callable, or None)
+    stage:          stage that is starting (Progress class)
+    """
+    
+    if progress is not None:
+        progress(stage.value)
+
+
+class MemoryMeter:
+    """
+    MemoryMeter:    a measure of the peak memory allocated while a calculation
+                    runs, through tracemalloc, which it starts if it is not 
+                    already tracing. Only memory allocated by Python and numpy
+                    is seen (so not OpenCV's own working memory), and the
+                    peak is shared by calculations running at the same time.
+    """
+    
+    # meters running, to which Trace passes on the peak before resetting it
+    # for each stage, and whether one of them started tracemalloc, which is
+    # then stopped when the last of them stops
+    running = set()
+    started = False
+    lock = threading.Lock()
+    
+    def __init__(self):
+        import tracemalloc
+        
+        with MemoryMeter.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                MemoryMeter.started = True
+            else:
+                MemoryMeter.note_peak()
+                tracemalloc.reset_peak()
+            self.allocated = tracemalloc.get_traced_memory()[0]
+            self._peak = self.allocated
+            MemoryMeter.running.add(self)
+    
+    @staticmethod
+    def note_peak():
+        """
+        note_peak:  pass the peak since tracemalloc was last reset on to the
+                    running meters (called with the lock held)
+        """
+        import tracemalloc
+        
+        peak = tracemalloc.get_traced_memory()[1]
+        for meter in MemoryMeter.running:
+            meter._peak = max(meter._peak, peak)
+    
+    def stop(self):
+        """
+        stop:       stop measuring, and stop tracemalloc if a meter started it
+                    and no other meter is still running
+        
+        returns:    peak memory allocated since the meter was created (bytes)
+        """
+        import tracemalloc
+        
+        with MemoryMeter.lock:
+            MemoryMeter.note_peak()
+            MemoryMeter.running.discard(self)
+            if MemoryMeter.started and not MemoryMeter.running:
+                tracemalloc.stop()
+                MemoryMeter.started = False
+        return self._peak - self.allocated
+
+
+class Trace:
+    """
+    Trace:      a record of the stages of a calculation, passed to it as 
+                progress and cancel are. For each stage it records:
+                
+                name        name of the stage
+                start       start time, from the creation of the trace (s)
+                wall        elapsed time (s)
+                cpu         CPU time of the whole process, so including any
+                            worker threads (s)
+                shape       shape of the image the stage produced
+                bytes       size of the arrays the stage produced
+                map_hits    map_cache hits during the stage
+                map_misses  map_cache misses during the stage
+                map_bytes   growth of map_cache during the stage
+                image_hits  image_cache hits during the stage, if it is set
+                peak_bytes  peak memory allocated during the stage, if
+                            tracemalloc is tracing (e.g. python -X tracemalloc)
+                cached      whether the stage was reused rather than computed
+                thread      native id of the thread that ran the stage
+                
+                The map_cache figures, and peak_bytes, are shared by stages 
+                running at the same time, so are approximate for concurrent
+                calculations. A calculation given a memory budget records in
+                memory how it was fitted to the budget, and its measured
+                peak (see make_rotary_adjusted).
+    """
+    
+    def __init__(self):
+        self.records = []
+        self.memory = None
+        self.origin = time.time()
+        self._perf_origin = time.perf_counter()
+        self._lock = threading.Lock()
+    
+    def run(self, name, function, *args, **kwargs):
+        """
+        run:        call a function as a stage of the calculation, recording 
+                    it
+        
+        name:       name of the stage (string)
+        function:   function computing the stage
+        
+        remaining arguments are passed to function
+        
+        returns:    result of function
+        """
+        
+        return self._record(name, function, args, kwargs, False)
+    
+    def reuse(self, name, result):
+        """
+        reuse:      record a stage whose earlier result was reused
+        
+        name:       name of the stage (string)
+        result:     result of the stage
+        
+        returns:    result
+        """
+        
+        return self._record(name, lambda : result, (), {}, True)
+    
+    def _record(self, name, function, args, kwargs, cached):
+        import tracemalloc
+        
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            with MemoryMeter.lock:
+                MemoryMeter.note_peak()
+                tracemalloc.reset_peak()
+            allocated = tracemalloc.get_traced_memory()[0]
+        cache = map_cache.info()
+        images = image_cache
+        image_hits = images.hits if images is not None else 0
+        wall, cpu = time.perf_counter(), time.process_time()
+        
+        result = function(*args, **kwargs)
+        
+        cpu, end = time.process_time() - cpu, time.perf_counter()
+        after = map_cache.info()
+        arrays = [a for a in (result if isinstance(result, tuple) else (result,)) if isinstance(a, np.ndarray)]
+        shape = arrays[0].shape if arrays else getattr(result, "size", ())[::-1]
+        record = dict(name = name,
+                      start = round(wall - self._perf_origin, 6),
+                      wall = round(end - wall, 6),
+                      cpu = round(cpu, 6),
+                      shape = list(shape),
+                      bytes = sum(a.nbytes for a in arrays),
+                      map_hits = after["hits"] - cache["hits"],
+                      map_misses = after["misses"] - cache["misses"],
+                      map_bytes = after["bytes"] - cache["bytes"],
+                      cached = cached,
+                      thread = threading.get_native_id())
+        if images is not None:
+            record["image_hits"] = images.hits - image_hits
+        if tracing:
+            record["peak_bytes"] = tracemalloc.get_traced_memory()[1] - allocated
+        with self._lock:
+            self.records.append(record)
+        
+        return result
+    
+    def totals(self):
+        """
+        totals:     return the wall and CPU time of each stage, summed over 
+                    any repeats of it
+        
+        returns:    dict of stage name to dict of wall and cpu (s)
+        """
+        
+        totals = {}
+        with self._lock:
+            for record in self.records:
+                total = totals.setdefault(record["name"], dict(wall = 0, cpu = 0))
+                total["wall"] += record["wall"]
+                total["cpu"] += record["cpu"]
+        return totals
+    
+    def events(self):
+        """
+        events:     return the stages as Chrome trace events (as shown by 
+                    chrome://tracing or https://ui.perfetto.dev), timed from
+                    the epoch so that traces of several processes line up
+        
+        returns:    list of trace events (list of dict)
+        """
+        
+        pid = os.getpid()
+        with self._lock:
+            return [dict(name = record["name"], 
+                         cat = "gore2", 
+                         ph = "X", 
+                         ts = round((self.origin + record["start"]) * 1e6), 
+                         dur = round(record["wall"] * 1e6), 
+                         pid = pid, 
+                         tid = record["thread"], 
+                         args = {k : v for k, v in record.items() if k not in ("name", "start", "wall", "thread")})
+                    for record in self.records]
+    
+    def save(self, path):
+        """
+        save:       write the stages as a Chrome trace-event JSON file
+        
+        path:       path to the trace file (string)
+        """
+        
+        save_trace_events(path, self.events())
+
+
+def save_trace_events(path, events):
+    """
+    save_trace_events:  write Chrome trace events, e.g. from Trace.events, to
+                        a JSON file
+    
+    path:               path to the trace file (string)
+    events:             trace events (list of dict)
+    """
+    
+    import json
+    
+    with open(path, "w") as f:
+        json.dump({"traceEvents" : events, "displayTimeUnit" : "ms"}, f)
+
+
+def traced(trace, name, function, *args, **kwargs):
+    """
+    traced:         call a function as a stage of a calculation, recording it
+                    in trace
+    
+    trace:          record of the calculation (Trace, or None not to record)
+    name:           name of the stage (string)
+    function:       function computing the stage
+    
+    remaining arguments are passed to function
+    
+    returns:        result of function
+    """
+    
+    if trace is None:
+        return function(*args, **kwargs)
+    return trace.run(name, function, *args, **kwargs)
+
+
+class MapCache:
+    """
+    MapCache    a bounded store of coordinate maps, keyed by geometry. Maps depend
+                only on image size and projection parameters, never on pixel
+                values, so they may be shared between renders. When the total
+                size exceeds max_bytes, the least recently used maps are evicted.
+    
+    max_bytes:  maximum total size of the stored maps (integer)
+    """
+    
+    def __init__(self, max_bytes = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._maps = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        
+    def get(self, key):
+        """
+        get:        return the maps stored under key, or None if not present
+        
+        key:        geometry key (hashable)
+        
+        returns:    tuple of maps (ndarray), or None
+        """
+        with self._lock:
+            maps = self._maps.get(key)
+            if maps is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._maps.move_to_end(key)
+            return maps
+        
+    def put(self, key, maps):
+        """
+        put:        store maps under key, evicting least recently used maps
+                    until the cache fits within max_bytes
+        
+        key:        geometry key (hashable)
+        maps:       tuple of maps (ndarray)
+        
+        returns:    the stored maps, made read-only
+        """
+        for m in maps:
+            m.setflags(write = False)
+        size = sum(m.nbytes for m in maps)
+        if size > self.max_bytes:
+            return maps
+        with self._lock:
+            if key in self._maps:
+                self._bytes -= sum(m.nbytes for m in self._maps.pop(key))
+            self._maps[key] = maps
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._maps.popitem(last = False)
+                self._bytes -= sum(m.nbytes for m in evicted)
+        return maps
+    
+    def clear(self):
+        """
+        clear:      remove all stored maps and reset the counters
+        """
+        with self._lock:
+            self._maps.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+            
+    def info(self):
+        """
+        info:       return the cache statistics
+        
+        returns:    dict of hits, misses, number of entries, bytes used and limit
+        """
+        with self._lock:
+            return dict(hits = self.hits, 
+                        misses = self.misses, 
+                        entries = len(self._maps), 
+                        bytes = self._bytes, 
+                        max_bytes = self.max_bytes)
+
+
+"""
+Global MapCache, shared by all renders in this process
+"""
+map_cache = MapCache()
+
+
+def compile_maps(x_src, y_src, *masks):
+    """
+    compile_maps:   convert float maps to the fixed-point format that cv2.remap
+                    uses internally (CV_16SC2 integer coordinates with CV_16UC1
+                    indices into its interpolation table), so that a remap 
+                    need not convert them again; the maps take 6 rather than 8 
+                    bytes per pixel, and remap to exactly the same image
+    
+    x_src:          x source coordinates (ndarray)
+    y_src:          y source coordinates (ndarray)
+    masks:          any further arrays to pass through unchanged (ndarray)
+    
+    returns:        (
+                     integer (x, y) source coordinates (ndarray),
+                     interpolation table indices (ndarray),
+                     *masks
+                     )
+    """
+    
+    xy, table = cv2.convertMaps(x_src, y_src, cv2.CV_16SC2)
+    
+    return (xy, table) + masks
+
+
+"""
+Default directory for the ImageCache files
+"""
+IMAGE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gore2", "images")
+
+
+class ImageCache:
+    """
+    ImageCache  an on-disk store of decoded images, as .npy files which are
+                memory-mapped when read, so that opening an image again costs
+                little more than mapping the file. Entries are keyed by the
+                path, modification time and size of the image file, and by the
+                scale it was decoded at, so an edited image is decoded afresh.
+                When the total size exceeds max_bytes, the least recently used
+                entries are deleted.
+    
+    directory:  directory for the cache files (string)
+    max_bytes:  maximum total size of the cache files (integer)
+    """
+    
+    def __init__(self, directory = IMAGE_CACHE_DIR, max_bytes = 2 * 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok = True)
+        
+    def _entry(self, path, scale):
+        """
+        _entry:     return the cache file for an image, or None if the image
+                    file does not exist
+        
+        path:       path to image (string)
+        scale:      scale the image is decoded at (float)
+        
+        returns:    path to the cache file (string), or None
+        """
+        import hashlib
+        
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = repr((os.path.abspath(path), stat.st_mtime_ns, stat.st_size, float(scale)))
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+        
+    def get(self, path, scale = 1):
+        """
+        get:        return the decoded image stored for path, or None if not 
+                    present
+        
+        path:       path to image (string)
+        scale:      scale the image was decoded at (float)
+        
+        returns:    read-only, memory-mapped image array (ndarray), or None
+        """
+        entry = self._entry(path, scale)
+        try:
+            im = np.load(entry, mmap_mode = "r")
+            # mark as recently used
+            os.utime(entry)
+        except (OSError, ValueError, TypeError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return im
+        
+    def put(self, path, scale, im):
+        """
+        put:        store a decoded image, deleting least recently used entries
+                    until the cache fits within max_bytes; failure to write is
+                    not an error, since the image is simply decoded next time
+        
+        path:       path to image (string)
+        scale:      scale the image was decoded at (float)
+        im:         image array (ndarray)
+        """
+        entry = self._entry(path, scale)
+        if entry is None or im.nbytes > self.max_bytes:
+            return
+        
+        # write to a temporary file and rename it, so that other threads and 
+        # processes never see a partial entry
+        temp = "{0}.{1}.{2}.tmp".format(entry, os.getpid(), threading.get_ident())
+        try:
+            with open(temp, "wb") as f:
+                np.save(f, im)
+            os.replace(temp, entry)
+        except OSError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            return
+        
+        self.evict()
+        
+    def evict(self):
+        """
+        evict:      delete least recently used entries until the cache fits 
+                    within max_bytes
+        """
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".npy"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    # still mapped, where the platform forbids deleting it
+                    continue
+                total -= size
+            
+    def clear(self):
+        """
+        clear:      delete all cache files and reset the counters
+        """
+        with self._lock:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".npy"):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+            self.hits = 0
+            self.misses = 0
+            
+    def info(self):
+        """
+        info:       return the cache statistics
+        
+        returns:    dict of hits, misses, number of entries, bytes used and limit
+        """
+        with self._lock:
+            sizes = [entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith(".npy")]
+            return dict(hits = self.hits, 
+                        misses = self.misses, 
+                        entries = len(sizes), 
+                        bytes = sum(sizes), 
+                        max_bytes = self.max_bytes)
+
+
+"""
+Global ImageCache used by image_from_path, or None to decode every image when
+it is opened; applications enable it with e.g. gore2.image_cache = 
+gore2.ImageCache()
+"""
+image_cache = None
+
+
+class BufferPool:
+    """
+    BufferPool  scratch arrays for the intermediate images of a render, kept
+                between renders so that rendering the same size again does 
+                not allocate them afresh. An array is taken from the pool for
+                the duration of a stage and given back once it is finished 
+                with, so renders running at the same time never share one; 
+                only arrays that are not returned to the caller may be pooled.
+    """
+    
+    def __init__(self):
+        self._buffers = {}
+        self._lock = threading.Lock()
+        
+    def take(self, name, shape, dtype = np.uint8):
+        """
+        take:       take an array from the pool, allocating it if the pool has
+                    none of this name, shape and type
+        
+        name:       name of the intermediate image (string)
+        shape:      shape of the array (tuple)
+        dtype:      type of the array (numpy dtype)
+        
+        returns:    uninitialised array (ndarray)
+        """
+        with self._lock:
+            buffer = self._buffers.pop(name, None)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype)
+        return buffer
+    
+    def give(self, name, buffer):
+        """
+        give:       give an array back to the pool, to be reused by the next
+                    stage taking this name
+        
+        name:       name of the intermediate image (string)
+        buffer:     array taken from the pool (ndarray)
+        """
+        with self._lock:
+            self._buffers[name] = buffer
+            
+    def clear(self):
+        """
+        clear:      release every array in the pool
+        """
+        with self._lock:
+            self._buffers.clear()
+
+
+"""
+Global BufferPool, shared by all renders in this process
+"""
+buffer_pool = BufferPool()
+
+
+"""
+Approximate peak working memory per output pixel while building the maps for
+each stage (bytes), used to size the bands in tiled mode
+"""
+EQUI_BYTES_PER_PIXEL = 8
+SWAP_BYTES_PER_PIXEL = 16
+EQUATORIAL_BYTES_PER_PIXEL = 20
+POLAR_BYTES_PER_PIXEL = 48
+
+
+"""
+Default memory budget for the maps in tiled mode (bytes)
+"""
+TILE_MEMORY = 64 * 1024 * 1024
+
+
+"""
+Approximate peak working memory per output pixel while building the composite
+maps, including the compiled maps (bytes)
+"""
+COMPOSITE_BYTES_PER_PIXEL = 54
+
+
+"""
+Smallest memory budget for the maps in tiled mode when fitting a calculation
+within a memory budget (bytes)
+"""
+MIN_TILE_MEMORY = 8 * 1024 * 1024
+
+
 """
-Global pyqtBoundSignal, used to emit calculation progress information
+Minimum number of strips to remap in turn when a calculation can be cancelled
 """
-signal = None
+CANCEL_STRIPS = 16
 
     
-def image_from_path(path):
+def image_from_path(path, scale = 1):
     """
-    image_from_path:    open an image as a numpy ndarray
+    image_from_path:    open an image as a numpy ndarray, optionally reducing
+                        its size: as much of the reduction as possible is made
+                        while decoding (for JPEG images, by DCT scaling), and 
+                        the rest by area interpolation
     
     path:               path to image (string)
     
-    returns             image array (ndarray)
+    scale:              factor by which to resize, at most 1 (float)
+    
+    returns             image array (ndarray), read-only if it comes from
+                        image_cache
     """
     
+    if image_cache is not None:
+        im = image_cache.get(path, scale)
+        if im is not None:
+            return im
+    
+    # decode at the largest reduction (by 2, 4 or 8) that keeps at least the
+    # desired resolution
+    reduction = max(r for r in (1, 2, 4, 8) if r * scale <= 1 or r == 1)
+    if reduction == 1:
+        flags = cv2.IMREAD_COLOR
+    else:
+        flags = getattr(cv2, "IMREAD_REDUCED_COLOR_{}".format(reduction))
+    
     # read the image
-    im = cv2.imread(path)
+    im = cv2.imread(path, flags)
+    if im is None:
+        raise ValueError("cannot read image {}".format(path))
+    
+    if scale != 1:
+        # the desired size is relative to the full image, whose size is read
+        # from its header, allowing for any rotation by its EXIF orientation;
+        # where PIL cannot read the header, the full image is decoded instead
+        try:
+            with Image.open(path) as f:
+                width, height = f.size
+        except Image.UnidentifiedImageError:
+            im = cv2.imread(path, cv2.IMREAD_COLOR)
+            height, width = im.shape[:2]
+        if (width > height) != (im.shape[1] > im.shape[0]):
+            width, height = height, width
+        down_points = (round(scale * width), round(scale * height))
+        im = cv2.resize(im, down_points, interpolation = cv2.INTER_AREA)
     
     # swap the red and blue channels
     imRgb = cv2.cvtColor(im, cv2.COLOR_RGB2BGR)
     
+    if image_cache is not None:
+        image_cache.put(path, scale, imRgb)
+    
     return imRgb
 
 
@@ -107,13 +921,31 @@ def deres_image(image, factor):
     # get image sizes
     height, width = image.shape[:2]
     
-    down_points = (round(factor * height), round(factor * width))
+    down_points = (round(factor * width), round(factor * height))
     
     resized_down = cv2.resize(image, down_points, interpolation = cv2.INTER_LINEAR)
     
     return resized_down
 
 
+def image_fingerprint(image):
+    """
+    image_fingerprint:  a cheap fingerprint of the contents of an image, from 
+                        its shape, type and a hash of a grid of at most 256 by
+                        256 of its pixels, so that an image changed in place 
+                        is (almost always) told apart from the image it was
+    
+    image:              the image (ndarray)
+    
+    returns:            fingerprint (tuple)
+    """
+    
+    height, width = image.shape[:2]
+    sample = image[::max(1, height // 256), ::max(1, width // 256)]
+    
+    return (image.shape, image.dtype.str, zlib.crc32(np.ascontiguousarray(sample).tobytes()))
+
+
 def deg2rad(x):
     """
     deg2rad:    return an angle give in degrees in radians
@@ -138,101 +970,807 @@ def rad2deg(x):
     return x / np.pi * 180
 
 
-def nd2im(arr):
+def angle_to_pixels(angle, angle_min, angle_max, n):
     """
-    nd2dim:     retun a PIL.Image from an ndarray
+    angle_to_pixels:    convert angles spanning an extent to pixel coordinates,
+                        in place
     
-    arr:        image array (ndarray)
+    angle:              angles (ndarray, modified in place)
+    angle_min:          angle at the start of the extent (radians)
+    angle_max:          angle at the end of the extent (radians)
+    n:                  number of pixels spanning the extent (integer)
     
-    returns     image (PIL.Image)
+    returns:            pixel coordinates (ndarray, the same array as angle)
     """
     
-    return Image.fromarray(arr, mode="RGBA")
+    np.subtract(angle, angle_min, out = angle)
+    np.multiply(angle, n, out = angle)
+    np.divide(angle, angle_max - angle_min, out = angle)
+    
+    return angle
 
 
-def make_equatorial (im,
-                    num_gores, 
-                    phi_min = -mt.pi / 2, 
-                    phi_max = mt.pi / 2, 
-                    lam_min = -mt.pi, 
-                    lam_max = mt.pi,
-                    phi_cap = mt.pi / 2,
-                    alpha_limit = mt.pi,
-                    projection = Projection.CASSINI):
+def remap_image(im, maps, shape, tile_memory = None, workers = None, bytes_per_pixel = 8, columns = None, 
+                cancel = None, dst = None, **kwargs):
+    """
+    remap_image:        remap an image, either with the whole (cached) maps, or
+                        in horizontal bands whose maps are built on demand so
+                        that the maps never exceed a memory budget
+    
+    im:                 source image (ndarray)
+    maps:               function of a (start, stop) range of output rows, or
+                        None for every row, returning the (x, y) maps, either
+                        as floats or compiled by compile_maps
+    shape:              shape of the output image (tuple)
+    tile_memory:        memory budget for the maps, or None to use the whole 
+                        maps (bytes)
+    workers:            number of strips or bands to work on at once (integer,
+                        defaults to one strip for the whole maps, or to the 
+                        number of CPUs for bands)
+    bytes_per_pixel:    working memory used by maps per output pixel (bytes)
+    columns:            bounds of the column strips (e.g. gores) to remap 
+                        concurrently with the whole maps, or None to split the
+                        rows evenly between the workers (sequence of integers)
+    cancel:             token checked before each strip or band (CancelToken)
+    dst:                array of the output shape and image type into which to
+                        remap, or None to allocate one (ndarray)
+    kwargs:             remaining arguments to cv2.remap
+    
+    returns:            output image (ndarray, dst if given), or None if 
+                        cancelled
     """
-    make_equatorial returns an image that can be used as a gore net
     
-    im:             input image (ndarray)
-    num_gores:      number of gores (integer)
-    phi_min:        minimum latitude (radians)    
-    phi_max:        maximum latitude (radians)
-    lam_min:        minimum longitude (radians)    
-    lam_max:        maximum longitude (radians)
-    phi_cap:        angular size of pole cap (radians)
-    alpha_limit:    no goring beyond this angle (radians)
-    projection:     projection to use (Projection class)
+    if is_cancelled(cancel):
+        return
     
-    returns:        image (ndarray)  
-    """
+    h, w = shape[:2]
+    if dst is None:
+        dst = np.empty(shape, dtype = im.dtype)
     
-    h, w = im.shape[:2]
+    if tile_memory is None:
+        x_src, y_src = maps(None)
+        if (not workers or workers < 2) and cancel is None:
+            cv2.remap(im, x_src, y_src, dst = dst, **kwargs)
+            return dst
+        
+        # each worker remaps its own strip of the maps into the shared output,
+        # with at least CANCEL_STRIPS strips so that a cancel is seen promptly
+        if columns is None:
+            rows = np.linspace(0, h, max(workers or 1, CANCEL_STRIPS) + 1).astype(int)
+            strips = [slice(rows[i], rows[i + 1]) for i in range(len(rows) - 1)]
+        else:
+            strips = [(slice(None), slice(columns[i], columns[i + 1])) for i in range(len(columns) - 1)]
+        
+        def remap_strip(strip):
+            if not is_cancelled(cancel):
+                cv2.remap(im, x_src[strip], y_src[strip], dst = dst[strip], **kwargs)
+        
+        tasks = strips
     
-    # create separate arrays of phi/lambda polar coordinates spanning the extent
-    phi_vector, lam_vector = np.linspace(phi_min, phi_max, h, dtype = np.float32), np.linspace(lam_min, lam_max, w, dtype = np.float32)
-    lam_dst, phi_dst = np.meshgrid(lam_vector, phi_vector)
+    else:
+        # size the bands so that the maps being worked on fit within the budget
+        workers = workers or os.cpu_count() or 1
+        band = max(1, int(tile_memory // (workers * bytes_per_pixel * w)))
+        
+        def remap_band(start):
+            if not is_cancelled(cancel):
+                stop = min(start + band, h)
+                x_src, y_src = maps((start, stop))
+                cv2.remap(im, x_src, y_src, dst = dst[start:stop], **kwargs)
+        
+        remap_strip, tasks = remap_band, range(0, h, band)
     
-    # create an index vector, used to find meridians
-    indx = np.arange(w, dtype = np.float32)
+    # cv2.remap releases the GIL, so the strips or bands can be remapped concurrently
+    if workers and workers > 1:
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            list(executor.map(remap_strip, tasks))
+    else:
+        for task in tasks:
+            remap_strip(task)
     
-    # calculate angular size of a gore
-    gore_width = (lam_max - lam_min) / num_gores
+    return None if is_cancelled(cancel) else dst
+
+
+def gore_columns(w, num_gores):
+    """
+    gore_columns:   return the column bounds of each gore in a gore net
     
-    # calculate the meridians and produce a coordinate array
-    lam00 = (indx // (w / num_gores)) * gore_width + gore_width / 2 + lam_min
-    lam0 = np.tile(lam00, (h,1))
+    w:              image width (integer)
+    num_gores:      number of gores (integer)
     
-    # do the appropriate projection (note, we use the reverse projection, i.e. 
-    # for every coordinate in the destination image, calculate its corresponding
-    # position in the source image.
-    if projection == Projection.SINUSOIDAL:
-        lam_src = ((lam_dst - lam0) / np.cos(phi_dst)) + lam0
-        phi_src = phi_dst
+    returns:        bounds, with gore i in columns [bounds[i], bounds[i+1])
+                    (ndarray)
+    """
+    
+    indx = np.arange(w, dtype = np.float32)
+    
+    return np.searchsorted(indx // (w / num_gores), np.arange(num_gores + 1))
+
+
+def nd2im(arr):
+    """
+    nd2dim:     retun a PIL.Image from an ndarray
+    
+    arr:        image array (ndarray)
+    
+    returns     image (PIL.Image)
+    """
+    
+    return Image.fromarray(arr, mode="RGBA")
+
+
+def alpha_blend(dst, src, alpha):
+    """
+    alpha_blend:    blend an image over another in place, rounding exactly as 
+                    PIL does when pasting through a mask
+    
+    dst:            image to blend over (ndarray, modified in place)
+    src:            image to blend, of the same shape as dst (ndarray)
+    alpha:          opacity of src, broadcastable to dst (ndarray)
+    """
+    
+    a = alpha.astype(np.uint16)
+    blended = dst * (255 - a) + src * a + 128
+    np.right_shift((blended >> 8) + blended, 8, out = blended)
+    dst[...] = blended
+
+
+def rgb_with_background(im, background_colour):
+    """
+    rgb_with_background:    as convert_to_rgb_with_background, for an image 
+                            array: an RGB image is returned as it is
+    
+    im:                     image array, greyscale, RGB or RGBA (ndarray)
+    background_colour:      background colour (R, G, B, A)
+    
+    returns:                RGB image array (ndarray)
+    """
+    
+    if im.dtype != np.uint8 or im.ndim not in (2, 3) or (im.ndim == 3 and im.shape[2] not in (3, 4)):
+        return np.array(convert_to_rgb_with_background(Image.fromarray(im), background_colour))
+    if im.ndim == 2:
+        return cv2.cvtColor(im, cv2.COLOR_GRAY2RGB)
+    if im.shape[2] == 4:
+        return flatten_image(im, background_colour)
+    return im
+
+
+def fundus_radius(angle):
+    """
+    fundus_radius:  return the distance from the centre of a fundus image of a
+                    point at a given angle from the centre of the eye, assuming
+                    a simple spherical eye model, with radius = 11mm and focal
+                    length = 17mm
+    
+    angle:          angle from the centre of the eye (radians)
+    
+    returns:        distance in the image plane (mm)
+    """
+    
+    return 17 * 11 * np.sin(angle) / (6 + 11 * np.cos(angle))
+
+
+def rotate_coords(x, y, h, w, rotation):
+    """
+    rotate_coords:  rotate pixel coordinates about the centre of an image: 
+                    sampling an image at the rotated coordinates rotates it as
+                    rotate_image does
+    
+    x:              x (column) coordinates (ndarray)
+    y:              y (row) coordinates (ndarray, broadcast against x)
+    h:              image height (integer)
+    w:              image width (integer)
+    rotation:       angle of rotation (degrees)
+    
+    returns:        (
+                     rotated x coordinates (ndarray),
+                     rotated y coordinates (ndarray)
+                     )
+    """
+    
+    theta = deg2rad(rotation)
+    c, s = np.float32(mt.cos(theta)), np.float32(mt.sin(theta))
+    cx, cy = np.float32((w - 1) / 2), np.float32((h - 1) / 2)
+    dx, dy = x - cx, y - cy
+    
+    x_rot = c * dx - s * dy
+    x_rot += cx
+    y_rot = s * dx + c * dy
+    y_rot += cy
+    
+    return x_rot, y_rot
+
+
+def clipped(expression):
+    """
+    clipped:        return a numexpr expression clipped to [-1, 1], as np.clip
+                    clips it (so that NaN is unchanged)
+    
+    expression:     numexpr expression (string)
+    
+    returns:        numexpr expression (string)
+    """
+    
+    return "where(({0}) > 1, 1, where(({0}) < -1, -1, ({0})))".format(expression)
+
+
+"""
+The inverse formulas of swap_inverse and gore_projection as numexpr 
+expressions, each giving the source (longitude, latitude) of the destination 
+latitude phi and longitude lam (from the central meridian, for the gores), or
+None where the source latitude is the destination latitude. The trigonometric
+functions of phi or lam alone (FUSED_TERMS) are evaluated by numpy, since phi
+and lam are often vectors broadcast against one another, leaving numexpr to 
+combine them; the orthographic radius is clipped to the domain of arcsin.
+"""
+RHO = clipped("sqrt(lam * lam + phi * phi)")
+FUSED_FORMULAS = {"swap" : ("arctan2(sin_lam * cos_phi, -sin_phi)", 
+                            "arcsin({})".format(clipped("cos_lam * cos_phi"))),
+                  Projection.SINUSOIDAL : ("lam / cos_phi", 
+                                           None),
+                  Projection.ORTHOGRAPHIC : ("arctan2(lam * sin(arcsin({0})), {0} * cos(arcsin({0})))".format(RHO), 
+                                             "arcsin({})".format(clipped("phi * sin(arcsin({0})) / {0}".format(RHO)))),
+                  Projection.CASSINI : ("arctan2(tan_lam, cos_phi)", 
+                                        "arcsin({})".format(clipped("sin_phi * cos_lam")))}
+FUSED_TERMS = {"cos_phi" : lambda phi, lam : np.cos(phi),
+               "sin_phi" : lambda phi, lam : np.sin(phi),
+               "cos_lam" : lambda phi, lam : np.cos(lam),
+               "sin_lam" : lambda phi, lam : np.sin(lam),
+               "tan_lam" : lambda phi, lam : np.tan(lam)}
+
+
+def fused(formula, phi_dst, lam_dst):
+    """
+    fused:          evaluate one of the formulas of FUSED_FORMULAS with 
+                    numexpr, in a single multi-threaded pass
+    
+    formula:        numexpr expression (string)
+    phi_dst:        destination latitude (radians)
+    lam_dst:        destination longitude (radians, broadcast against phi_dst)
+    
+    returns:        result (ndarray)
+    """
+    
+    operands = dict(phi = phi_dst, lam = lam_dst)
+    for name, term in FUSED_TERMS.items():
+        if name in formula:
+            operands[name] = term(phi_dst, lam_dst)
+    
+    return numexpr.evaluate(formula, local_dict = operands)
+
+
+def fused_inverse(phi_dst, lam_dst, formulas):
+    """
+    fused_inverse:  evaluate the inverse formulas of FUSED_FORMULAS with 
+                    numexpr
+    
+    phi_dst:        destination latitude (radians)
+    lam_dst:        destination longitude (radians, broadcast against phi_dst)
+    formulas:       key of the formulas in FUSED_FORMULAS ("swap" or 
+                    Projection class)
+    
+    returns:        (
+                     source longitude (radians),
+                     source latitude (radians)
+                     )
+    """
+    
+    lam_formula, phi_formula = FUSED_FORMULAS[formulas]
+    lam_src = fused(lam_formula, phi_dst, lam_dst)
+    if phi_formula is None:
+        phi_src = np.empty_like(lam_src)
+        phi_src[...] = phi_dst
+    else:
+        phi_src = fused(phi_formula, phi_dst, lam_dst)
+    
+    return lam_src, phi_src
+
+
+def swap_longitude(phi_dst, lam_dst):
+    """
+    swap_longitude: the source longitude of swap_inverse
+    
+    arguments are as swap_inverse
+    
+    returns:        source longitude (radians)
+    """
+    
+    if numexpr is not None:
+        return fused(FUSED_FORMULAS["swap"][0], phi_dst, lam_dst)
+    lam_src = np.multiply(np.sin(lam_dst), np.cos(phi_dst))
+    np.arctan2(lam_src, -np.sin(phi_dst), out = lam_src)
+    
+    return lam_src
+
+
+def swap_latitude(phi_dst, lam_dst):
+    """
+    swap_latitude:  the source latitude of swap_inverse, which depends on the
+                    destination latitude only through its cosine
+    
+    arguments are as swap_inverse
+    
+    returns:        source latitude (radians)
+    """
+    
+    if numexpr is not None:
+        return fused(FUSED_FORMULAS["swap"][1], phi_dst, lam_dst)
+    phi_src = np.multiply(np.cos(lam_dst), np.cos(phi_dst))
+    np.clip(phi_src, -1, 1, out = phi_src)
+    np.arcsin(phi_src, out = phi_src)
+    
+    return phi_src
+
+
+def swap_inverse(phi_dst, lam_dst):
+    """
+    swap_inverse:   the inverse of the rotation performed by swap: for each
+                    destination coordinate, calculate the source coordinate
+    
+    phi_dst:        destination latitude (radians)
+    lam_dst:        destination longitude (radians)
+    
+    returns:        (
+                     source longitude (radians),
+                     source latitude (radians)
+                     )
+    """
+    
+    # this is a pi/2 rotation about the y-axis; the arguments may be broadcast
+    # against one another, and the only full-size arrays are the two results
+    return swap_longitude(phi_dst, lam_dst), swap_latitude(phi_dst, lam_dst)
+
+
+def gore_projection(phi_dst, lam_offset, projection):
+    """
+    gore_projection the inverse of the projection of a single gore: for each
+                    destination coordinate, calculate the source coordinate.
+                    Longitudes are relative to the central meridian of the gore,
+                    so the result is the same for every gore.
+    
+    phi_dst:        destination latitude (radians)
+    lam_offset:     destination longitude from the central meridian (radians)
+    projection:     projection to use (Projection class)
+    
+    returns:        (
+                     source longitude from the central meridian (radians),
+                     source latitude (radians)
+                     )
+    """
+    
+    if numexpr is not None:
+        return fused_inverse(phi_dst, lam_offset, projection)
+    
+    if projection == Projection.SINUSOIDAL:
+        lam_src = lam_offset / np.cos(phi_dst)
+        phi_src = np.empty_like(lam_src)
+        phi_src[...] = phi_dst
     elif projection == Projection.ORTHOGRAPHIC:
-        x = (lam_dst - lam0)
+        x = lam_offset
         y = phi_dst
         rho = np.sqrt(np.square(x) + np.square(y))
         rho = np.clip(rho, -1, 1) # use np.clip to limit rho to domain of arcsin
         c = np.arcsin(rho)
         phi_src = np.arcsin(np.clip(y * np.sin(c) / rho, -1, 1))
-        lam_src = lam0 + np.arctan2(x * np.sin(c), rho * np.cos(c))
-        rho_max = np.array(np.greater(rho, phi_cap) * 100, dtype = np.float32)
-        phi_src += rho_max
-        lam_src += rho_max
+        lam_src = np.arctan2(x * np.sin(c), rho * np.cos(c))
     else: # Cassini
-        lam_src = lam0 + np.arctan2(np.tan(lam_dst - lam0), np.cos(phi_dst))
-        phi_src = np.arcsin(np.clip(np.sin(phi_dst) * np.cos(lam_dst - lam0), -1, 1))
+        lam_src = np.arctan2(np.tan(lam_offset), np.cos(phi_dst))
+        phi_src = np.arcsin(np.clip(np.sin(phi_dst) * np.cos(lam_offset), -1, 1))
+        
+    return lam_src, phi_src
+
+
+def gore_limits(lam_src, phi_src, phi_dst, lam_offset, lam0, gore_width, phi_cap, alpha_limit, projection):
+    """
+    gore_limits     move source coordinates produced by gore_projection far out
+                    of range where they fall outside their own gore, beyond the 
+                    alpha limit or beyond the cap, and restore the central 
+                    meridian. lam_src and phi_src are modified in place.
+    
+    lam_src:        source longitude from the central meridian (radians)
+    phi_src:        source latitude (radians)
+    phi_dst:        destination latitude (radians)
+    lam_offset:     destination longitude from the central meridian (radians)
+    lam0:           central meridian of the gore containing each coordinate (radians)
+    gore_width:     angular size of a gore (radians)
+    phi_cap:        angular size of pole cap (radians)
+    alpha_limit:    no goring beyond this angle (radians)
+    projection:     projection to use (Projection class)
+    
+    returns:        (
+                     source longitude (radians),
+                     source latitude (radians)
+                     )
+    """
+    
+    # the source coordinates are adjusted in place, using a single boolean mask
+    beyond = np.empty(lam_src.shape, dtype = bool)
+    
+    # limit the orthographic projection to the cap
+    if projection == Projection.ORTHOGRAPHIC:
+        rho = np.add(np.square(lam_offset), np.square(phi_dst))
+        np.sqrt(rho, out = rho)
+        np.greater(np.clip(rho, -1, 1, out = rho), phi_cap, out = beyond)
+        del rho
+        np.add(phi_src, 100, out = phi_src, where = beyond)
+        np.add(lam_src, 100, out = lam_src, where = beyond)
     
     # limit each projection to within its own gore
-    lam_src = lam_src + np.array(np.greater(lam_src, lam0 + gore_width / 2) * 1000, dtype = np.float32)
-    lam_src = lam_src + np.array(np.less(lam_src, lam0 - gore_width / 2) * -1000, dtype = np.float32)
+    np.add(lam_src, 1000, out = lam_src, where = np.greater(lam_src, gore_width / 2, out = beyond))
+    np.add(lam_src, -1000, out = lam_src, where = np.less(lam_src, -gore_width / 2, out = beyond))
     
     # apply the alpha limit
-    phi_src = phi_src + np.array(np.greater(phi_src, alpha_limit - mt.pi / 2) * 1000, dtype = np.float32)
+    np.add(phi_src, 1000, out = phi_src, where = np.greater(phi_src, alpha_limit - mt.pi / 2, out = beyond))
+    
+    np.add(lam_src, lam0, out = lam_src)
+    
+    return lam_src, phi_src
+
+
+def gore_inverse(phi_dst, lam_dst, lam0, gore_width, phi_cap, alpha_limit, projection):
+    """
+    gore_inverse:   the inverse of the gore projection used by make_equatorial:
+                    for each destination coordinate, calculate the source 
+                    coordinate. Coordinates that fall outside their own gore, 
+                    beyond the alpha limit or beyond the cap are moved far out 
+                    of range.
+    
+    phi_dst:        destination latitude (radians)
+    lam_dst:        destination longitude (radians)
+    lam0:           central meridian of the gore containing each coordinate (radians)
+    gore_width:     angular size of a gore (radians)
+    phi_cap:        angular size of pole cap (radians)
+    alpha_limit:    no goring beyond this angle (radians)
+    projection:     projection to use (Projection class)
+    
+    returns:        (
+                     source longitude (radians),
+                     source latitude (radians)
+                     )
+    """
+    
+    lam_offset = lam_dst - lam0
+    lam_src, phi_src = gore_projection(phi_dst, lam_offset, projection)
+    
+    return gore_limits(lam_src, phi_src, phi_dst, lam_offset, lam0, gore_width, phi_cap, alpha_limit, projection)
+
+
+def equatorial_maps (h,
+                     w,
+                     num_gores, 
+                     phi_min = -mt.pi / 2, 
+                     phi_max = mt.pi / 2, 
+                     lam_min = -mt.pi, 
+                     lam_max = mt.pi,
+                     phi_cap = mt.pi / 2,
+                     alpha_limit = mt.pi,
+                     projection = Projection.CASSINI,
+                     rows = None,
+                     compiled = False):
+    """
+    equatorial_maps returns the source coordinate maps used by make_equatorial,
+                    reusing previously computed maps from map_cache. The maps 
+                    are built in place, so at most about 13 bytes per pixel are
+                    allocated (20 for the orthographic projection), including 
+                    the 8 bytes per pixel of the maps themselves.
+    
+    h:              image height (integer)
+    w:              image width (integer)
+    rows:           (start, stop) range of rows to map, or None to map (and
+                    cache) the whole image
+    compiled:       whether whole maps are compiled by compile_maps before 
+                    they are cached (boolean)
+    
+    remaining arguments are as make_equatorial
+    
+    returns:        (
+                     x source coordinates (ndarray),
+                     y source coordinates (ndarray)
+                     )
+    """
+    
+    key = ("equatorial", h, w, num_gores, phi_min, phi_max, lam_min, lam_max, phi_cap, alpha_limit, projection, compiled)
+    if rows is None:
+        maps = map_cache.get(key)
+        if maps is not None:
+            return maps
+    start, stop = rows or (0, h)
+    
+    # create an array of latitudes spanning the extent
+    phi_vector = np.linspace(phi_min, phi_max, h, dtype = np.float32)[start:stop]
+    
+    # create an index vector, used to find meridians
+    indx = np.arange(w, dtype = np.float32)
+    
+    # calculate angular size of a gore
+    gore_width = (lam_max - lam_min) / num_gores
+    
+    # calculate the meridians, and the offset of each column from its meridian:
+    # the offsets are found in double precision, as they are magnified close to
+    # the poles
+    gore_index = indx // (w / num_gores)
+    lam00 = gore_index * gore_width + gore_width / 2 + lam_min
+    lam_offset = np.linspace(lam_min, lam_max, w) - (gore_index.astype(np.float64) * gore_width + gore_width / 2 + lam_min)
+    lam_offset = lam_offset.astype(np.float32)
+    
+    # every gore has the same geometry relative to its own meridian, so do the 
+    # (reverse) projection just once, over a band of offsets wide enough to hold
+    # any gore, sampled at the spacing of the columns
+    lam_step = (lam_max - lam_min) / (w - 1)
+    band = int(mt.ceil(gore_width / 2 / lam_step)) + 2
+    band_offset = np.arange(-band, band + 1, dtype = np.float32) * np.float32(lam_step)
+    lam_src = np.empty((stop - start, w), dtype = np.float32)
+    phi_src = np.empty((stop - start, w), dtype = np.float32)
+    bounds = gore_columns(w, num_gores)
+    
+    # the band is as wide as a gore, so work a few rows at a time to save memory
+    hair = lam_step / 100
+    for first in range(0, stop - start, 64):
+        phi_rows = phi_vector[first : first + 64, np.newaxis]
+        lam_block, phi_block = lam_src[first : first + 64], phi_src[first : first + 64]
+        band_lam, band_phi = gore_projection(phi_rows, band_offset, projection)
+        step_lam, step_phi = np.diff(band_lam, axis = 1), np.diff(band_phi, axis = 1)
+        
+        # each gore then copies its columns from the band: the meridians need not
+        # fall on a whole column, so each gore interpolates the band at its own phase
+        starts = []
+        for i in range(num_gores):
+            left, right = bounds[i], bounds[i + 1]
+            position = left - (i + 0.5) * gore_width / lam_step + band
+            k = int(mt.floor(position))
+            phase = np.float32(position - k)
+            for band_src, band_step, src in ((band_lam, step_lam, lam_block), (band_phi, step_phi, phi_block)):
+                np.multiply(band_step[:, k : k + right - left], phase, out = src[:, left:right])
+                np.add(src[:, left:right], band_src[:, k : k + right - left], out = src[:, left:right])
+            starts.append(k)
+        
+        # pixels whose source falls within a hair of the edge of the gore or of 
+        # the alpha limit could land on either side of it when interpolated, so 
+        # find the columns of the band that come that close to an edge...
+        # (the orthographic projection moves every pixel beyond the cap out of 
+        # range, and no latitude lies beyond an alpha limit of pi)
+        edges = np.zeros(2 * band, dtype = bool)
+        limits = ((band_lam, -gore_width / 2), (band_lam, gore_width / 2))
+        if alpha_limit < mt.pi:
+            limits += ((band_phi, alpha_limit - mt.pi / 2),)
+        inside = np.abs(phi_rows[:, 0]) <= phi_cap if projection == Projection.ORTHOGRAPHIC else slice(None)
+        for band_src, edge in limits:
+            low, high = np.minimum(band_src[inside, :-1], band_src[inside, 1:]), np.maximum(band_src[inside, :-1], band_src[inside, 1:])
+            edges |= ((low - 2 * hair < edge) & (edge < high + 2 * hair)).any(axis = 0)
+        if projection == Projection.ORTHOGRAPHIC:
+            edges &= np.minimum(np.abs(band_offset[:-1]), np.abs(band_offset[1:])) <= phi_cap
+        edges = np.flatnonzero(edges)
+        near = np.concatenate([left + m[(m >= 0) & (m < right - left)] for left, right, m in 
+                               zip(bounds[:-1], bounds[1:], (edges - k for k in starts))])
+        
+        # ...where the band bends too sharply to be interpolated (as the Cassini 
+        # projection does close to the poles), or is not defined (as the 
+        # orthographic projection is not at its centre), do the projection directly
+        bend = ~((np.abs(np.diff(step_lam, axis = 1)) + np.abs(np.diff(step_phi, axis = 1))) <= hair)
+        del band_lam, band_phi, step_lam, step_phi
+        r = np.flatnonzero(bend.any(axis = 1))
+        lam_block[r], phi_block[r] = gore_projection(phi_rows[r], lam_offset, projection)
+        
+        # ...and so too for the pixels in those columns that are close to an edge
+        lam_near, phi_near = lam_block[:, near], phi_block[:, near]
+        r, c = np.nonzero((np.abs(np.abs(lam_near) - gore_width / 2) < hair) | 
+                          (np.abs(phi_near - (alpha_limit - mt.pi / 2)) < hair))
+        lam_block[r, near[c]], phi_block[r, near[c]] = gore_projection(phi_rows[r, 0], lam_offset[near[c]], projection)
+    
+    lam_src, phi_src = gore_limits(lam_src, phi_src, phi_vector[:, np.newaxis], lam_offset, lam00, 
+                                   gore_width, phi_cap, alpha_limit, projection)
+    
+    # convert polar coordinates back to source pixels, reusing the buffers
+    y_src = angle_to_pixels(phi_src, phi_min, phi_max, h)
+    x_src = angle_to_pixels(lam_src, lam_min, lam_max, w)
+    
+    if rows is not None:
+        return x_src, y_src
+    return map_cache.put(key, compile_maps(x_src, y_src) if compiled else (x_src, y_src))
+
+
+def make_equatorial (im,
+                    num_gores, 
+                    phi_min = -mt.pi / 2, 
+                    phi_max = mt.pi / 2, 
+                    lam_min = -mt.pi, 
+                    lam_max = mt.pi,
+                    phi_cap = mt.pi / 2,
+                    alpha_limit = mt.pi,
+                    projection = Projection.CASSINI,
+                    tile_memory = None,
+                    workers = None,
+                    cancel = None,
+                    dst = None):
+    """
+    make_equatorial returns an image that can be used as a gore net
+    
+    im:             input image, RGB or RGBA (ndarray)
+    num_gores:      number of gores (integer)
+    phi_min:        minimum latitude (radians)    
+    phi_max:        maximum latitude (radians)
+    lam_min:        minimum longitude (radians)    
+    lam_max:        maximum longitude (radians)
+    phi_cap:        angular size of pole cap (radians)
+    alpha_limit:    no goring beyond this angle (radians)
+    projection:     projection to use (Projection class)
+    tile_memory:    memory budget for the maps, if working in bands (bytes)
+    workers:        number of threads (integer)
+    cancel:         token checked before each gore or band (CancelToken)
+    dst:            RGBA array into which to project, or None to allocate one
+                    (ndarray)
+    
+    returns:        RGBA image (ndarray), or None if cancelled
+    """
+    
+    h, w = im.shape[:2]
     
-    # convert polar coordinates back to source pixels
-    y_src = (phi_src - phi_min) * h / (phi_max - phi_min)
-    x_src = (lam_src - lam_min) * w / (lam_max - lam_min)
+    maps = lambda rows : equatorial_maps(h, w, num_gores, phi_min, phi_max, lam_min, lam_max, phi_cap, alpha_limit, projection, 
+                                         rows, compiled = True)
     
-    # handle transparency
-    transparent_img = np.zeros((h, w, 4), dtype=np.uint8)
-    bgra = cv2.cvtColor(im, cv2.COLOR_RGB2RGBA)
+    # handle transparency: the (transparent) border is used beyond each gore
+    if im.shape[2] == 3:
+        im = cv2.cvtColor(im, cv2.COLOR_RGB2RGBA)
     
-    # perform the projection
-    dst = cv2.remap(bgra, x_src, y_src, cv2.INTER_LINEAR, transparent_img)
+    # perform the projection: with the whole maps, each gore is remapped separately
+    dst = remap_image(im, maps, (h, w, 4), tile_memory, workers, EQUATORIAL_BYTES_PER_PIXEL, 
+                      columns = gore_columns(w, num_gores), cancel = cancel, dst = dst, interpolation = cv2.INTER_LINEAR)
     
     return(dst)
     
 
+def polar_coords(x, y, ht, wd, num_gores):
+    """
+    polar_coords    the inverse of the layout produced by make_polar: for each
+                    pixel of the pole-stitched image, calculate the pixel of the
+                    equatorial gore net that is placed there. The pole lies at
+                    the centre of the output and the i-th gore runs outwards from
+                    it, rotated anticlockwise by i gore widths.
+    
+    x:              output column coordinates (ndarray)
+    y:              output row coordinates (ndarray)
+    ht:             height of the equatorial gore net (integer)
+    wd:             width of the equatorial gore net (integer)
+    num_gores:      number of gores (integer)
+    
+    returns:        (
+                     gore net column coordinates (ndarray),
+                     gore net row coordinates (ndarray),
+                     mask of pixels covered by a gore (ndarray)
+                     )
+    """
+    
+    rads_per_meridian = 2 * mt.pi / num_gores
+    gore_wd = wd / num_gores
+    
+    # offsets from the pole, which lies at the centre of the output
+    dx = x + np.float32(0.5 - ht)
+    dy = y + np.float32(0.5 - ht)
+    
+    # each pixel belongs to the gore whose centre line is closest in angle
+    gore = np.mod(np.rint(np.arctan2(dx, dy) / rads_per_meridian), num_gores)
+    omega = gore * rads_per_meridian
+    
+    # rotate back into the frame of the gore: across (s) and along (t) the strip
+    cos_omega, sin_omega = np.cos(omega), np.sin(omega)
+    s = cos_omega * dx - sin_omega * dy
+    t = sin_omega * dx + cos_omega * dy
+    
+    x_src = gore * gore_wd + s + (gore_wd / 2 - 0.5)
+    y_src = t - 0.5
+    covered = (np.abs(s) <= gore_wd / 2) & (t >= 0) & (t <= ht)
+    
+    return x_src, y_src, covered
+
+
+def swap_coords(x, y, h, w, phi_extent, lam_extent):
+    """
+    swap_coords     the inverse of swap in pixel coordinates: for each pixel of
+                    the swapped image, calculate the pixel of the source image
+    
+    x:              swapped column coordinates (ndarray)
+    y:              swapped row coordinates (ndarray)
+    h:              image height (integer)
+    w:              image width (integer)
+    phi_extent:     latitudinal extent of the source image (float)
+    lam_extent:     longitudinal extent of the source image (float)
+    
+    returns:        (
+                     source column coordinates (ndarray),
+                     source row coordinates (ndarray)
+                     )
+    """
+    
+    phi_dst = y * np.float32(mt.pi / (h - 1)) - np.float32(mt.pi / 2)
+    lam_dst = x * np.float32(2 * mt.pi / (w - 1))
+    lam_src, phi_src = swap_inverse(phi_dst, lam_dst)
+    x_src = (lam_src + lam_extent) * (w / (2 * lam_extent))
+    y_src = (phi_src + phi_extent) * (h / (2 * phi_extent))
+    
+    return x_src, y_src
+
+
+def cap_coords(dx, dy, ht, wd, num_gores, phi_cap):
+    """
+    cap_coords      the inverse of the pole cap produced by polecap_from_equi: for each
+                    pixel, given by its offset from the centre of the cap, 
+                    calculate the pixel of the swapped, double-width image 
+                    that is shown there
+    
+    dx:             column offsets from the centre of the cap (ndarray)
+    dy:             row offsets from the centre of the cap (ndarray)
+    ht:             height of the double-width swapped image (integer)
+    wd:             width of the double-width swapped image (integer)
+    num_gores:      number of gores (integer)
+    phi_cap:        angular size of the cap (radians)
+    
+    returns:        (
+                     source column coordinates (ndarray),
+                     source row coordinates (ndarray),
+                     mask of pixels covered by the cap (ndarray)
+                     )
+    """
+    
+    # the cap is rotated by half a gore to match the orientation of make_polar
+    angle = mt.pi / num_gores
+    x = np.float32(mt.cos(angle)) * dx + np.float32(mt.sin(angle)) * dy + np.float32(wd / 2 - 0.5)
+    y = np.float32(-mt.sin(angle)) * dx + np.float32(mt.cos(angle)) * dy + np.float32(ht / 2 - 0.5)
+    
+    # orthographic projection of a single gore, limited to the cap
+    phi_dst = y * np.float32(mt.pi / (ht - 1)) - np.float32(mt.pi / 2)
+    lam_dst = x * np.float32(2 * mt.pi / (wd - 1)) - np.float32(mt.pi)
+    lam_src, phi_src = gore_inverse(phi_dst, lam_dst, np.float32(0), 2 * mt.pi, phi_cap, mt.pi, Projection.ORTHOGRAPHIC)
+    x = (lam_src + mt.pi) * (wd / (2 * mt.pi))
+    y = (phi_src + mt.pi / 2) * (ht / mt.pi)
+    capped = (x > -0.5) & (x < wd - 0.5) & (y > -0.5) & (y < ht - 0.5)
+    
+    # the cap is swapped back before projection
+    x_src, y_src = np.full_like(x, -10), np.full_like(y, -10)
+    x_src[capped], y_src[capped] = swap_coords(x[capped], y[capped], ht, wd, mt.pi / 2, mt.pi)
+    
+    return x_src, y_src, capped
+
+
+def polar_maps(ht, wd, num_gores, rows = None, compiled = False):
+    """
+    polar_maps      returns the source coordinate maps used by make_polar, 
+                    reusing previously computed maps from map_cache
+    
+    ht:             height of the equatorial gore net (integer)
+    wd:             width of the equatorial gore net (integer)
+    num_gores:      number of gores (integer)
+    rows:           (start, stop) range of rows to map, or None to map (and
+                    cache) the whole image
+    compiled:       whether whole maps are compiled by compile_maps before 
+                    they are cached (boolean)
+    
+    returns:        (
+                     x source coordinates (ndarray),
+                     y source coordinates (ndarray)
+                     )
+    """
+    
+    key = ("polar", ht, wd, num_gores, compiled)
+    if rows is None:
+        maps = map_cache.get(key)
+        if maps is not None:
+            return maps
+    
+    # the output is twice the height of the gore net in each direction
+    start, stop = rows or (0, 2 * ht)
+    y, x = np.indices((stop - start, 2 * ht), dtype = np.float32)
+    y += start
+    x_src, y_src, covered = polar_coords(x, y, ht, wd, num_gores)
+    
+    # pixels not covered by any gore take the (transparent) border
+    x_src[~covered] = -10
+    y_src[~covered] = -10
+    
+    if rows is not None:
+        return x_src, y_src
+    return map_cache.put(key, compile_maps(x_src, y_src) if compiled else (x_src, y_src))
+
+
 def make_polar (im, 
                num_gores, 
                phi_min = -mt.pi / 2, 
@@ -240,11 +1778,43 @@ def make_polar (im,
                lam_min = -mt.pi, 
                lam_max = mt.pi,
                alpha_limit = mt.pi,
-               projection = Projection.CASSINI):
+               projection = Projection.CASSINI,
+               tile_memory = None,
+               workers = None,
+               cancel = None):
     """
     make_polar returns an image stitched at the pole that may be used a gore net
     
-    im:             input image (ndarray)
+    arguments are as make_polar_array
+    
+    returns:        output image (PIL.Image), or None if cancelled
+    """
+    
+    pole_stitched = make_polar_array(im, num_gores, phi_min, phi_max, lam_min, lam_max, alpha_limit, projection, 
+                                     tile_memory, workers, cancel)
+    if pole_stitched is None:
+        return
+    
+    return nd2im(pole_stitched)
+
+
+def make_polar_array (im, 
+                     num_gores, 
+                     phi_min = -mt.pi / 2, 
+                     phi_max = mt.pi / 2, 
+                     lam_min = -mt.pi, 
+                     lam_max = mt.pi,
+                     alpha_limit = mt.pi,
+                     projection = Projection.CASSINI,
+                     tile_memory = None,
+                     workers = None,
+                     cancel = None,
+                     dst = None):
+    """
+    make_polar_array returns an image stitched at the pole that may be used a 
+    gore net, as an array
+    
+    im:             input image, RGB or RGBA (ndarray)
     num_gores:      number of gores (integer)
     phi_min:        minimum latitude (radians)    
     phi_max:        maximum latitude (radians)
@@ -252,52 +1822,43 @@ def make_polar (im,
     lam_max:        maximum longitude (radians)
     alpha_limit:    angular extent of gored region
     projection:     projection to use (Projection class)
+    tile_memory:    memory budget for the maps, if working in bands (bytes)
+    workers:        number of threads (integer)
+    cancel:         token checked before each gore, strip or band (CancelToken)
+    dst:            RGBA array, twice as high as im, into which to stitch the
+                    gores, or None to allocate one (ndarray)
     
-    returns:        output image (PIL.Image)
+    returns:        RGBA image (ndarray), or None if cancelled
     """
     
     # demand that the pole is included if the gores are to be stitched at the pole
     phi_min = -mt.pi / 2
     
-    # calculate basic quantities
+    # perform the goring, into a pooled array as it is only needed until the
+    # gores are stitched
     ht, wd = im.shape[:2]
-    ang_wd = lam_max - lam_min    
-    rads_per_meridian = ang_wd / num_gores
-    degs_per_meridian = rad2deg(rads_per_meridian)
-    gore_wd = wd // num_gores
-    
-    # create new image for the output
-    pole_stitched = Image.new(mode = "RGBA", size = (2 * ht, 2 * ht))
-    
-    # perform the goring
-    equator_stitched_arr = make_equatorial(im = im, 
-                                           num_gores = num_gores,
-                                           phi_min = phi_min, 
-                                           phi_max = phi_max, 
-                                           lam_min = lam_min,
-                                           lam_max = lam_max,
-                                           alpha_limit = alpha_limit,
-                                           projection = projection)
-    
-    # convert to PIL.Image
-    equator_stitched = nd2im(equator_stitched_arr)
-    
-    # crop each gore, rotate it and repaste it in the rotary pattern
-    for i in range(num_gores):
-        strip = equator_stitched.crop((i * gore_wd, 0, (i+1) * gore_wd, ht))
-        ht3 = int(ht * 1.5)
-        gore = Image.new(mode = "RGBA", size = (ht3, ht3))
-        left = (ht3 - gore_wd) // 2
-        gore.paste(strip, box=(left, 0))
-        gore = gore.rotate((i) * degs_per_meridian)
-        ht2 = ht3 // 2
-        omega = (i) * rads_per_meridian
-        pos_x, pos_y = ht2 * (1 + mt.sin(omega)) - (ht3 - ht), ht2 * (1 + mt.cos(omega)) - (ht3 - ht)
-        pos_x, pos_y = int(pos_x), int(pos_y)
-        
-        # using the gore as a mask means that the pasted bakground is transparent
-        pole_stitched.paste(gore, (pos_x, pos_y), mask = gore)
-        
+    equator_buffer = buffer_pool.take("equatorial", (ht, wd, 4))
+    equator_stitched = make_equatorial(im = im, 
+                                       num_gores = num_gores,
+                                       phi_min = phi_min, 
+                                       phi_max = phi_max, 
+                                       lam_min = lam_min,
+                                       lam_max = lam_max,
+                                       alpha_limit = alpha_limit,
+                                       projection = projection,
+                                       tile_memory = tile_memory,
+                                       workers = workers,
+                                       cancel = cancel,
+                                       dst = equator_buffer)
+    
+    # place every gore in the rotary pattern with a single remap
+    pole_stitched = None
+    if equator_stitched is not None:
+        maps = lambda rows : polar_maps(ht, wd, num_gores, rows, compiled = True)
+        pole_stitched = remap_image(equator_stitched, maps, (2 * ht, 2 * ht, 4), tile_memory, workers, 
+                                    POLAR_BYTES_PER_PIXEL, cancel = cancel, dst = dst, interpolation = cv2.INTER_LINEAR)
+    buffer_pool.give("equatorial", equator_buffer)
+    
     return pole_stitched
     
 def convert_to_rgb_with_background(im, background_colour):
@@ -319,7 +1880,68 @@ def convert_to_rgb_with_background(im, background_colour):
     else:
         return im.convert("RGB")
 
-def swap(im, phi_extent=mt.pi / 2, lam_extent=mt.pi, background_colour=(0, 0, 0, 0)):
+def swap_maps(h, w, phi_extent, lam_extent, rows = None, compiled = False):
+    """
+    swap_maps   returns the source coordinate maps used by swap, reusing 
+                previously computed maps from map_cache. The rotation is
+                evaluated on vectors of latitude and longitude broadcast 
+                against one another, and the y map is symmetric about the
+                equator, so the only full-size arrays created are the two 
+                maps themselves and half of the y map (10 bytes per pixel).
+    
+    h:          image height (integer)
+    w:          image width (integer)
+    rows:       (start, stop) range of rows to map, or None to map (and
+                cache) the whole image
+    compiled:   whether whole maps are compiled by compile_maps before they
+                are cached (boolean)
+    
+    remaining arguments are as swap
+    
+    returns:    (
+                 x source coordinates (ndarray),
+                 y source coordinates (ndarray)
+                 )
+    """
+    
+    key = ("swap", h, w, phi_extent, lam_extent, compiled)
+    if rows is None:
+        maps = map_cache.get(key)
+        if maps is not None:
+            return maps
+    start, stop = rows or (0, h)
+    
+    # Calculate the angular extents
+    phi_dst_min, phi_dst_max, lam_dst_min, lam_dst_max = -np.pi / 2, np.pi / 2, 0, 2 * np.pi
+    phi_src_min, phi_src_max, lam_src_min, lam_src_max = -phi_extent, phi_extent, -lam_extent, lam_extent
+
+    # Create vectors of polar coordinates spanning the extent
+    phi_vector, lam_vector = np.linspace(phi_dst_min, phi_dst_max, h, dtype=np.float32), np.linspace(lam_dst_min, lam_dst_max, w, dtype=np.float32)
+
+    # Prepare the rotation: this is a pi/2 rotation about the y-axis
+    phi_rows = phi_vector[start:stop]
+    lam_src = swap_longitude(phi_rows[:, np.newaxis], lam_vector)
+    x_src = angle_to_pixels(lam_src, lam_src_min, lam_src_max, w)
+    
+    # The source latitude is the same in rows reflected in the equator, so is
+    # only calculated for the upper row of each pair whose cosines are exactly
+    # equal, and copied to the lower
+    index = np.arange(stop - start)
+    mirror = (h - 1 - start) - index
+    reflected = (mirror >= 0) & (mirror < index)
+    reflected[reflected] = np.cos(phi_rows[reflected]) == np.cos(phi_rows[mirror[reflected]])
+    kept = np.flatnonzero(~reflected)
+    phi_src = swap_latitude(phi_rows[kept, np.newaxis], lam_vector)
+    y_src = angle_to_pixels(phi_src, phi_src_min, phi_src_max, h)
+    if len(kept) < len(index):
+        y_src = y_src[np.searchsorted(kept, np.where(reflected, mirror, index))]
+    
+    if rows is not None:
+        return x_src, y_src
+    return map_cache.put(key, compile_maps(x_src, y_src) if compiled else (x_src, y_src))
+
+
+def swap(im, phi_extent=mt.pi / 2, lam_extent=mt.pi, background_colour=(0, 0, 0, 0), tile_memory=None, workers=None, cancel=None, dst=None):
     """
     swap    takes an equirectangular (plate-caree) projection of a certain
             angular extent and rotates it about the y-axis, so the poles lie
@@ -329,39 +1951,94 @@ def swap(im, phi_extent=mt.pi / 2, lam_extent=mt.pi, background_colour=(0, 0, 0,
     phi_extent:             Latitudinal extent (float)
     lam_extent:             Longitudinal extent (float)
     background_colour:      Background color to use beyond extent (R, G, B, A tuple)
+    tile_memory:            Memory budget for the maps, if working in bands (bytes)
+    workers:                Number of threads (integer)
+    cancel:                 Token checked before each strip or band (CancelToken)
+    dst:                    Array into which to remap, or None to allocate one (ndarray)
 
-    Returns:                Output image (ndarray)
+    Returns:                Output image (ndarray), or None if cancelled
     """
     # Calculate basic quantities
     h, w = im.shape[:2]
+    maps = lambda rows : swap_maps(h, w, phi_extent, lam_extent, rows, compiled = True)
 
-    # Calculate the angular extents
-    phi_dst_min, phi_dst_max, lam_dst_min, lam_dst_max = -np.pi / 2, np.pi / 2, 0, 2 * np.pi
-    phi_src_min, phi_src_max, lam_src_min, lam_src_max = -phi_extent, phi_extent, -lam_extent, lam_extent
-
-    # Create arrays of polar coordinates spanning the extent
-    phi_vector, lam_vector = np.linspace(phi_dst_min, phi_dst_max, h, dtype=np.float32), np.linspace(lam_dst_min, lam_dst_max, w, dtype=np.float32)
-    lam_dst, phi_dst = np.meshgrid(lam_vector, phi_vector)
+    # Perform the remap
+    r, g, b, _ = background_colour
+    dst = remap_image(im, maps, im.shape, tile_memory, workers, SWAP_BYTES_PER_PIXEL, cancel=cancel, dst=dst,
+                      interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=(r, g, b))
 
-    # Prepare the rotation: this is a pi/2 rotation about the y-axis
-    phi_src = np.arcsin(np.clip(np.cos(lam_dst) * np.cos(phi_dst), -1, 1))
-    lam_src = np.arctan2(np.sin(lam_dst) * np.cos(phi_dst), -np.sin(phi_dst))
-    y_src = (phi_src - phi_src_min) * h / (phi_src_max - phi_src_min)
-    x_src = (lam_src - lam_src_min) * w / (lam_src_max - lam_src_min)
+    return dst
 
-    # Create a background color image
-    r, g, b, _ = background_colour
-    background_image = np.zeros((h, w, 3), dtype=np.uint8)
-    background_image[:, :] = (r, g, b)
 
-    # Perform the remap
-    dst = cv2.remap(im, x_src, y_src, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=(r, g, b))
+def equi_maps(ht, wd, alpha_max, rows = None, rotation = 0, compiled = False):
+    """
+    equi_maps    returns the source coordinate maps used by equi, reusing 
+                 previously computed maps from map_cache. The projection is
+                 separable: x depends only on latitude and y only on longitude,
+                 so each is evaluated on a vector and broadcast into the maps,
+                 which are the only full-size arrays created (8 bytes per pixel).
+                 Any rotation of the fundus is applied to the maps.
+    
+    ht:          image height (integer)
+    wd:          image width (integer)
+    alpha_max:   angular size of the projection from the centre (radians)
+    rows:        (start, stop) range of rows to map, or None to map (and
+                 cache) the whole image
+    rotation:    angle by which to rotate the fundus about its centre (degrees)
+    compiled:    whether whole maps are compiled by compile_maps before they
+                 are cached (boolean)
+    
+    returns:     (
+                  x source coordinates (ndarray),
+                  y source coordinates (ndarray)
+                  )
+    """
+    
+    key = ("equi", ht, wd, alpha_max, rotation, compiled)
+    if rows is None:
+        maps = map_cache.get(key)
+        if maps is not None:
+            return maps
+    start, stop = rows or (0, wd)
+    
+    phi_max = lam_max = alpha_max
+    phi_min, lam_min = -phi_max, -lam_max
+    Lp_max = fundus_radius(phi_max)
+    
+    # prepare polar coordinate vectors that span the extent: latitude varies 
+    # along the columns of the output and longitude down the rows
+    phis = np.linspace(phi_min, phi_max, ht, dtype = np.float32)
+    lams = np.linspace(lam_min, lam_max, wd, dtype = np.float32)[start:stop]
 
-    return dst
+    # calculate the source coordinates for each destination coordinate
+    Lp_x = fundus_radius(phis)
+    Lp_y = fundus_radius(lams)
+    
+    x_vector = np.floor(Lp_x / Lp_max * ht / 2 + ht / 2)
+    y_vector = np.floor(Lp_y / Lp_max * wd / 2 + wd / 2)[:, np.newaxis]
+    
+    if rotation:
+        # rotating the fundus about its centre mixes the coordinates, so the
+        # maps are no longer separable
+        x, y = rotate_coords(x_vector, y_vector, ht, wd, rotation)
+    else:
+        x = np.empty((stop - start, ht), dtype = np.float32)
+        y = np.empty((stop - start, ht), dtype = np.float32)
+        x[:] = x_vector
+        y[:] = y_vector
+    
+    if rows is not None:
+        return x, y
+    return map_cache.put(key, compile_maps(x, y) if compiled else (x, y))
 
 
 def equi(im, 
-         alpha_max):
+         alpha_max,
+         tile_memory = None,
+         workers = None,
+         cancel = None,
+         rotation = 0,
+         dst = None):
     """
     equi         takes a fundus image and computes its equirectangular (plate caree) 
                  projection assuming a simple spherical eye model, with radius = 11mm
@@ -370,12 +2047,23 @@ def equi(im,
     im           input image (ndarray)
             
     alpha_max    angular size of the image from the centre (radians)
+    
+    tile_memory  memory budget for the maps, if working in bands (bytes)
+    
+    workers      number of threads (integer)
+    
+    cancel       token checked before each strip or band (CancelToken)
+    
+    rotation     angle by which to rotate the fundus about its centre (degrees)
+    
+    dst          array into which to remap, transposed with respect to im, or
+                 None to allocate one (ndarray)
             
     returns:     (
                   output image (ndarray), 
                   lambda max (float), 
                   phi max (float)
-                  )
+                  ), or None if cancelled
     
     """
     
@@ -385,58 +2073,319 @@ def equi(im,
     # subtract a small amount (1 degree) to avoid going off the edge
     alpha_max -= deg2rad(1.0)
     phi_max = lam_max = float(alpha_max)
-    phi_min, lam_min = -phi_max, -lam_max
-    Lp_max = 17 * 11 * np.sin(phi_max) / (6 + 11 * np.cos(phi_max))
-    
-    # prepare polar coordinate arrays that span the extent
-    phis = np.linspace(phi_min, phi_max, ht, dtype = np.float32)
-    lams = np.linspace(lam_min, lam_max, wd, dtype = np.float32)
-    phi, lam = np.meshgrid(phis, lams)
-
-    # calculate the source angular coordinates for each pair of destination coordinates
-    Lp_x = 17 * 11 * np.sin(phi) / (6 + 11 * np.cos(phi))
-    Lp_y = 17 * 11 * np.sin(lam) / (6 + 11 * np.cos(lam))
-    
-    x = np.floor(Lp_x / Lp_max * ht / 2 + ht / 2)
-    y = np.floor(Lp_y / Lp_max * wd / 2 + wd / 2)
+    maps = lambda rows : equi_maps(ht, wd, phi_max, rows, rotation, compiled = True)
             
-    # perform the remap
-    equi_image = cv2.remap(im, x, y, cv2.INTER_LINEAR) 
+    # perform the remap: the output is transposed with respect to the input
+    equi_image = remap_image(im, maps, (wd, ht) + im.shape[2:], tile_memory, workers, EQUI_BYTES_PER_PIXEL, 
+                             cancel = cancel, dst = dst, interpolation = cv2.INTER_LINEAR)
+    if equi_image is None:
+        return
             
     return (equi_image, float(lam_max), float(phi_max))
 
 
-def polecap (im, 
-            num_gores, 
-            lam_extent = mt.pi, 
-            phi_extent = mt.pi / 2, 
-            phi_cap = mt.pi / 2):
+def polecap_maps(h, w, num_gores, lam_extent, phi_extent, phi_cap, compiled = False):
+    """
+    polecap_maps    returns the source coordinate maps used by polecap_from_equi, reusing
+                    previously computed maps from map_cache. Only the square
+                    bounding the cap is mapped.
+    
+    h:              height of the equirectangular image (integer)
+    w:              width of the equirectangular image (integer)
+    compiled:       whether the maps are compiled by compile_maps before they
+                    are cached (boolean)
+    
+    remaining arguments are as polecap_from_equi
+    
+    returns:        (
+                     x source coordinates (ndarray),
+                     y source coordinates (ndarray),
+                     mask of pixels covered by the cap (ndarray)
+                     )
     """
-    polecap    produce a polar cap to paste onto a set of gores
-               joined at the pole, to allow for a "no-cut" zone.
+    
+    key = ("polecap", h, w, num_gores, lam_extent, phi_extent, phi_cap, compiled)
+    maps = map_cache.get(key)
+    if maps is not None:
+        return maps
+    
+    # the cap is projected from the swapped image, doubled in width
+    ht, wd = h, 2 * w
+    radius = int(phi_cap * ht / mt.pi) + 2
+    y, x = np.indices((2 * radius, 2 * radius), dtype = np.float32)
+    x_cap, y_cap, capped = cap_coords(x + np.float32(0.5 - radius), y + np.float32(0.5 - radius), ht, wd, num_gores, phi_cap)
+    
+    # double-width image -> swapped image -> equirectangular image
+    x_src, y_src = np.full_like(x, -10), np.full_like(y, -10)
+    x_src[capped], y_src[capped] = swap_coords((x_cap[capped] + 0.5) / 2 - 0.5, y_cap[capped], h, w, phi_extent, lam_extent)
+    
+    maps = (x_src, y_src, capped)
+    return map_cache.put(key, compile_maps(*maps) if compiled else maps)
+
+
+def polecap_from_equi (im, 
+                       num_gores, 
+                       lam_extent = mt.pi, 
+                       phi_extent = mt.pi / 2, 
+                       phi_cap = mt.pi / 2,
+                       background_colour = (0, 0, 0, 0)):
+    """
+    polecap_from_equi  produce a polar cap to paste onto a set of gores
+                       joined at the pole, to allow for a "no-cut" zone. The 
+                       cap is centred in a square image just large enough to
+                       hold it. This replaces polecap, which took the swapped, 
+                       double-width image instead of the output of equi.
+    
+    arguments are as polecap_from_equi_array
+    
+    returns:           output image (PIL.Image)
+    """
+    
+    return nd2im(polecap_from_equi_array(im, num_gores, lam_extent, phi_extent, phi_cap, background_colour))
+
+
+def polecap_from_equi_array (im, 
+                             num_gores, 
+                             lam_extent = mt.pi, 
+                             phi_extent = mt.pi / 2, 
+                             phi_cap = mt.pi / 2,
+                             background_colour = (0, 0, 0, 0),
+                             dst = None):
+    """
+    polecap_from_equi_array   produce the polar cap of polecap_from_equi, as an array
                
-    im:        input image (ndarray)
-    num_gores  number of gores (integer)
-    lam_extent latitudnal extent (float)
-    phi_extent longitudnal extent (float)
-    phi_cap    angular extent of the cap to create
+    im:             input image, as produced by equi: not the swapped image (ndarray)
+    num_gores       number of gores (integer)
+    lam_extent      latitudnal extent, as returned by equi (float)
+    phi_extent      longitudnal extent, as returned by equi (float)
+    phi_cap         angular extent of the cap to create
+    background_colour background colour to use beyond extent (R,G,B,A tuple)
+    dst             RGBA array of the size of the cap into which to remap, or
+                    None to allocate one (ndarray)
+    
+    returns:        RGBA image (ndarray)
+    """
+    
+    h, w = im.shape[:2]
+    x_src, y_src, capped = polecap_maps(h, w, num_gores, lam_extent, phi_extent, phi_cap, compiled = True)
+    
+    # pixels beyond the extent take the (opaque) background colour...
+    r, g, b, _ = background_colour
+    rgba_buffer = buffer_pool.take("polecap", (h, w, 4))
+    rgba = cv2.cvtColor(im, cv2.COLOR_RGB2RGBA, dst = rgba_buffer) if im.shape[2] == 3 else im
+    if dst is None:
+        dst = np.empty(capped.shape + (4,), np.uint8)
+    cv2.remap(rgba, x_src, y_src, cv2.INTER_LINEAR, dst = dst, borderMode = cv2.BORDER_CONSTANT, borderValue = (r, g, b, 255))
+    buffer_pool.give("polecap", rgba_buffer)
+    
+    # ...while pixels beyond the cap are transparent
+    dst[~capped] = 0
+    
+    return dst
+
+
+def composite_maps(ht,
+                   wd,
+                   alpha_max,
+                   num_gores,
+                   phi_no_cut,
+                   alpha_limit = mt.pi,
+                   projection = Projection.CASSINI,
+                   rotation = 0,
+                   compiled = False,
+                   cancel = None):
+    """
+    composite_maps  returns maps taking each pixel of the gore net produced by
+                    make_rotary directly to a pixel of the fundus image, by 
+                    chaining the inverse of every stage (equi, swap, the 
+                    doubling of width, make_equatorial, make_polar and polecap_from_equi)
+                    so that the whole net may be produced by a single remap.
+                    Maps are reused from map_cache where possible.
+    
+    ht:             height of the fundus image (integer)
+    wd:             width of the fundus image (integer)
+    compiled:       whether the maps are compiled by compile_maps before they
+                    are cached (boolean)
+    cancel:         token checked between the steps of the calculation 
+                    (CancelToken)
+    
+    remaining arguments are as make_rotary
+    
+    returns:        (
+                     x source coordinates (ndarray),
+                     y source coordinates (ndarray),
+                     mask of pixels covered by the net (ndarray)
+                     ), or None if cancelled
+    """
+    
+    key = ("composite", ht, wd, alpha_max, num_gores, phi_no_cut, alpha_limit, projection, rotation, compiled)
+    maps = map_cache.get(key)
+    if maps is not None:
+        return maps
+    
+    # sizes of the intermediate images of the staged pipeline: the equirectangular
+    # image is transposed with respect to the fundus, and is doubled in width 
+    # after it has been swapped
+    alpha = alpha_max - deg2rad(1.0)
+    h1, w1 = wd, ht
+    h2, w2 = h1, 2 * w1
+    size = 2 * h2
+    gore_width = 2 * mt.pi / num_gores
+    
+    y, x = np.indices((size, size), dtype = np.float32)
+    
+    # the gores: pole-stitched layout -> equatorial gore net, a band of rows at
+    # a time so that a cancel is seen promptly
+    x_net = np.empty((size, size), dtype = np.float32)
+    y_net = np.empty((size, size), dtype = np.float32)
+    covered = np.empty((size, size), dtype = bool)
+    for first in range(0, size, 256):
+        if is_cancelled(cancel):
+            return
+        band = slice(first, first + 256)
+        x_net[band], y_net[band], covered[band] = polar_coords(x[band], y[band], h2, w2, num_gores)
+    x_net, y_net = x_net[covered], y_net[covered]
+    phi_dst = y_net * np.float32(mt.pi / (h2 - 1)) - np.float32(mt.pi / 2)
+    lam_dst = x_net * np.float32(2 * mt.pi / (w2 - 1)) - np.float32(mt.pi)
+    lam0 = (x_net // (w2 / num_gores)) * gore_width + (gore_width / 2 - mt.pi)
+    lam_src, phi_src = gore_inverse(phi_dst, lam_dst, lam0, gore_width, mt.pi / 2, alpha_limit, projection)
+    x_gore = (lam_src + mt.pi) * (w2 / (2 * mt.pi))
+    y_gore = (phi_src + mt.pi / 2) * (h2 / mt.pi)
+    if is_cancelled(cancel):
+        return
+    
+    # the cap: rotated orthographic projection, centred over the pole. Only the 
+    # square bounding the no-cut disc is considered.
+    radius = int(phi_no_cut * h2 / mt.pi) + 2
+    cap_x0, cap_y0 = round((size - w2) / 2), round((size - h2) / 2)
+    cx, cy = cap_x0 + w2 / 2, cap_y0 + h2 / 2
+    top, bottom = max(int(cy) - radius, 0), min(int(cy) + radius, size)
+    left, right = max(int(cx) - radius, 0), min(int(cx) + radius, size)
+    dx = x[top:bottom, left:right] + np.float32(0.5 - cx)
+    dy = y[top:bottom, left:right] + np.float32(0.5 - cy)
+    x_cap, y_cap, capped = cap_coords(dx, dy, h2, w2, num_gores, phi_no_cut)
+    x_cap, y_cap = x_cap[capped], y_cap[capped]
+    
+    # gather the net, with the cap pasted over the gores
+    x_net = np.full((size, size), -10, dtype = np.float32)
+    y_net = np.full((size, size), -10, dtype = np.float32)
+    x_net[covered], y_net[covered] = x_gore, y_gore
+    covered &= (x_net > -0.5) & (x_net < w2 - 0.5) & (y_net > -0.5) & (y_net < h2 - 0.5)
+    capped_region = np.zeros((size, size), dtype = bool)
+    capped_region[top:bottom, left:right] = capped
+    x_net[capped_region], y_net[capped_region] = x_cap, y_cap
+    covered |= capped_region
+    x_net, y_net = x_net[covered], y_net[covered]
+    if is_cancelled(cancel):
+        return
+    
+    # double-width image -> swapped image
+    x_net = (x_net + 0.5) / 2 - 0.5
+    
+    # swapped image -> equirectangular image
+    x_equi, y_equi = swap_coords(x_net, y_net, h1, w1, alpha, alpha)
+    beyond = (x_equi < -0.5) | (x_equi > w1 - 0.5) | (y_equi < -0.5) | (y_equi > h1 - 0.5)
+    if is_cancelled(cancel):
+        return
+    
+    # equirectangular image -> fundus
+    Lp_max = fundus_radius(alpha)
+    x_src = fundus_radius(x_equi * np.float32(2 * alpha / (ht - 1)) - np.float32(alpha)) * np.float32(ht / 2 / Lp_max) + np.float32(ht / 2)
+    y_src = fundus_radius(y_equi * np.float32(2 * alpha / (wd - 1)) - np.float32(alpha)) * np.float32(wd / 2 / Lp_max) + np.float32(wd / 2)
+    if rotation:
+        x_src, y_src = rotate_coords(x_src, y_src, ht, wd, rotation)
     
-    returns:   output image (PIL.Image)
+    if is_cancelled(cancel):
+        return
+    
+    # anything beyond the extent of the fundus takes the background colour
+    x_src[beyond] = -10
+    y_src[beyond] = -10
+    
+    x_map = np.full((size, size), -10, dtype = np.float32)
+    y_map = np.full((size, size), -10, dtype = np.float32)
+    x_map[covered], y_map[covered] = x_src, y_src
+    
+    maps = (x_map, y_map, covered)
+    return map_cache.put(key, compile_maps(*maps) if compiled else maps)
+
+
+def make_rotary_composite_array(im, 
+                                alpha_max, 
+                                num_gores,   
+                                phi_no_cut,
+                                alpha_limit = mt.pi,
+                                projection = Projection.CASSINI,
+                                background_colour = (0, 0, 0, 0),
+                                workers = None,
+                                progress = None,
+                                cancel = None,
+                                rotation = 0,
+                                trace = None):
     """
+    make_rotary_composite_array produce the same gore net as make_rotary, but 
+                                resampling the fundus image only once, using 
+                                the maps from composite_maps
+    
+    arguments are as make_rotary
     
-    # the function takes an already "swapped" image, so first swap it back to normal
-    swapped = swap(im = im, lam_extent = lam_extent, phi_extent = phi_extent)
+    returns:                    output image (RGBA numpy array), or None if 
+                                cancelled
+    """
     
-    # perform the orthographic projection
-    output  = make_equatorial(swapped, num_gores = 1, phi_cap = phi_cap, projection = Projection.ORTHOGRAPHIC)
+    report(progress, Progress.EQUI)
     
-    # convert to PIL.Image
-    polecap = nd2im(output)
+    ht, wd = im.shape[:2]
+    maps = traced(trace, "composite maps", composite_maps, ht, wd, alpha_max, num_gores, phi_no_cut, 
+                  alpha_limit, projection, rotation, compiled = True, cancel = cancel)
+    if maps is None or is_cancelled(cancel):
+        return
+    x_src, y_src, covered = maps
+    
+    report(progress, Progress.POLAR)
+    
+    # pixels beyond the fundus take the (opaque) background colour...
+    r, g, b, _ = background_colour
+    rgba_buffer = buffer_pool.take("composite", (ht, wd, 4))
+    rgba = cv2.cvtColor(im, cv2.COLOR_RGB2RGBA, dst = rgba_buffer)
+    dst = traced(trace, "composite remap", remap_image, rgba, lambda rows : (x_src, y_src), covered.shape + (4,), 
+                 workers = workers, cancel = cancel, interpolation = cv2.INTER_LINEAR, borderMode = cv2.BORDER_CONSTANT, 
+                 borderValue = (r, g, b, 255))
+    buffer_pool.give("composite", rgba_buffer)
+    if dst is None:
+        return
     
-    # rotate the cap to match the orientation of the image produced by make_polar
-    polecap = polecap.rotate(- 180 / num_gores)
+    # ...while pixels not covered by the net are transparent
+    dst[~covered] = 0
     
-    return polecap
+    return dst
+
+
+def make_rotary_composite(im, 
+                          alpha_max, 
+                          num_gores,   
+                          phi_no_cut,
+                          alpha_limit = mt.pi,
+                          projection = Projection.CASSINI,
+                          background_colour = (0, 0, 0, 0),
+                          workers = None,
+                          progress = None,
+                          cancel = None,
+                          rotation = 0,
+                          trace = None):
+    """
+    make_rotary_composite   produce the gore net as make_rotary_composite_array
+    
+    arguments are as make_rotary_composite_array
+    
+    returns:                output image (PIL.Image), or None if cancelled
+    """
+    
+    rotary = make_rotary_composite_array(im, alpha_max, num_gores, phi_no_cut, alpha_limit, projection, 
+                                         background_colour, workers, progress, cancel, rotation, trace)
+    if rotary is None:
+        return
+    return nd2im(rotary)
 
 
 def make_rotary (im, 
@@ -445,7 +2394,14 @@ def make_rotary (im,
                 phi_no_cut,
                 alpha_limit = mt.pi,
                 projection = Projection.CASSINI,
-                background_colour = (0, 0, 0, 0)):
+                background_colour = (0, 0, 0, 0),
+                mode = Mode.STAGED,
+                tile_memory = TILE_MEMORY,
+                workers = None,
+                progress = None,
+                cancel = None,
+                rotation = 0,
+                trace = None):
     """
     make_rotary          master function to produce a gore net stitched at the pole
     
@@ -457,67 +2413,344 @@ def make_rotary (im,
     alpha_limit:         angular extent of gored region
     projection:          projection to use (Projection class)
     background_colour    background colour to use beyond fundus (R,G,B,A tuple)
+    mode:                STAGED to run each stage in turn, COMPOSITE to 
+                         resample the fundus once, or TILED to run each stage
+                         in bands within a memory budget (Mode class)
+    tile_memory:         memory budget for the maps in TILED mode (bytes)
+    workers:             number of threads, each rendering its own gores or
+                         bands (integer, defaults to one thread, or to the 
+                         number of CPUs in TILED mode)
+    progress:            function called with the value of each stage as it
+                         starts (callable taking a Progress value)
+    cancel:              token checked between stages and between the gores,
+                         strips or bands within them (CancelToken)
+    rotation:            angle by which to rotate the fundus about its centre,
+                         applied as part of the equirectangular maps (degrees)
+    trace:               record of the time and memory taken by each stage 
+                         (Trace, or None not to record them)
+    
+    returns:             output image (PIL.Image), or None if cancelled
     """
     
-    if (isinstance(signal, pyqtBoundSignal)):
-        signal.emit(Progress.EQUI.value)
+    if mode == Mode.COMPOSITE:
+        return make_rotary_composite(im, alpha_max, num_gores, phi_no_cut, alpha_limit, projection, background_colour, 
+                                     workers, progress, cancel, rotation, trace)
+    
+    # the maps for each stage are only built a band at a time in TILED mode
+    if mode != Mode.TILED:
+        tile_memory = None
+    
+    upstream = make_upstream(im, alpha_max, background_colour, tile_memory, workers, progress, cancel, rotation, trace)
+    if upstream is None:
+        return
+    
+    rotary = make_downstream(upstream, num_gores, phi_no_cut, alpha_limit, projection, background_colour, 
+                             tile_memory, workers, progress, cancel, trace)
+    if rotary is None:
+        return
+    
+    return nd2im(rotary)
+
+
+def make_upstream(im, alpha_max, background_colour = (0, 0, 0, 0), tile_memory = None, workers = None, 
+                  progress = None, cancel = None, rotation = 0, trace = None):
+    """
+    make_upstream        the stages of make_rotary that do not depend on the 
+                         gores: the equirectangular representation of the 
+                         fundus, and its rotation to the pole
+    
+    arguments are as make_rotary
+    
+    returns:             (
+                          equirectangular image (ndarray),
+                          rotated image, twice as wide as high (RGBA 
+                          ndarray),
+                          longitude extent (radians),
+                          latitude extent (radians)
+                          ), or None if cancelled
+    """
+    
+    report(progress, Progress.EQUI)
     
     # create the equirectangular (plate-caree) representation of the fundus
-    fundus_equi, lammax, phimax = equi(im = im, alpha_max = alpha_max)
+    equi_result = traced(trace, "equi", equi, im = im, alpha_max = alpha_max, tile_memory = tile_memory, workers = workers, 
+                         cancel = cancel, rotation = rotation)
     
-    if QThread.currentThread().isInterruptionRequested():
+    if is_cancelled(cancel):
         return
     
-    if (isinstance(signal, pyqtBoundSignal)):
-        signal.emit(Progress.SWAP.value)
+    fundus_equi, lammax, phimax = equi_result
+    
+    report(progress, Progress.SWAP)
     
     # rotate the representation so that the centre of the fundus lies at the "north pole"
-    fundus_swapped = swap(fundus_equi, phi_extent = phimax, lam_extent = lammax, background_colour = background_colour)
+    fundus_swapped_resized = traced(trace, "swap", swap_resized, fundus_equi, phimax, lammax, background_colour, tile_memory, 
+                                    workers, cancel)
     
-    if QThread.currentThread().isInterruptionRequested():
+    if fundus_swapped_resized is None:
         return
     
-    if (isinstance(signal, pyqtBoundSignal)):
-        signal.emit(Progress.POLAR.value)
+    return fundus_equi, fundus_swapped_resized, lammax, phimax
+
+
+def swap_resized(fundus_equi, phimax, lammax, background_colour = (0, 0, 0, 0), tile_memory = None, workers = None, 
+                 cancel = None):
+    """
+    swap_resized         rotate the equirectangular representation so that the
+                         centre of the fundus lies at the "north pole", as 
+                         swap, then prepare it for make_polar_array
+    
+    fundus_equi:         equirectangular image, as produced by equi (ndarray)
+    phimax:              latitude extent (radians)
+    lammax:              longitude extent (radians)
     
-    # get image sizes
-    swapped_height, swapped_width = fundus_swapped.shape[:2]
+    remaining arguments are as make_rotary
+    
+    returns:             rotated image, twice as wide as high (RGBA ndarray),
+                         or None if cancelled
+    """
+    
+    # the rotated image is only needed until it is resized
+    swapped_buffer = buffer_pool.take("swap", fundus_equi.shape)
+    fundus_swapped = swap(fundus_equi, phi_extent = phimax, lam_extent = lammax, background_colour = background_colour, 
+                          tile_memory = tile_memory, workers = workers, cancel = cancel, dst = swapped_buffer)
+    
+    fundus_swapped_resized = None
+    if fundus_swapped is not None:
+        # get image sizes
+        swapped_height, swapped_width = fundus_swapped.shape[:2]
+        
+        # double the width of the image: make_polar expects the equirectangular
+        # representation to be twice as wide as it is high, since the longitude is in
+        # [0,2pi] and latitude is in [-pi/2,pi/2]
+        resized_buffer = buffer_pool.take("swap resized", (swapped_height, swapped_width * 2, 3))
+        cv2.resize(fundus_swapped, (swapped_width * 2, swapped_height), dst = resized_buffer)
+        
+        # make_equatorial needs the transparency, which is added here once 
+        # rather than each time the gores change
+        fundus_swapped_resized = cv2.cvtColor(resized_buffer, cv2.COLOR_RGB2RGBA)
+        buffer_pool.give("swap resized", resized_buffer)
+    buffer_pool.give("swap", swapped_buffer)
+    
+    return fundus_swapped_resized
+
+
+def make_downstream(upstream,
+                    num_gores,
+                    phi_no_cut,
+                    alpha_limit = mt.pi,
+                    projection = Projection.CASSINI,
+                    background_colour = (0, 0, 0, 0),
+                    tile_memory = None,
+                    workers = None,
+                    progress = None,
+                    cancel = None,
+                    trace = None):
+    """
+    make_downstream      the stages of make_rotary that depend on the gores: 
+                         the polar gore pattern, with the pole cap pasted over
+                         its centre
     
-    # double the width of the image: make_polar expects the equirectangular
-    # representation to be twice as wide as it is high, since the longitude is in
-    # [0,2pi] and latitude is in [-pi/2,pi/2]
-    fundus_swapped_resized = cv2.resize(fundus_swapped, (swapped_width * 2, swapped_height)) 
+    upstream:            result of make_upstream (tuple)
     
-    if QThread.currentThread().isInterruptionRequested():
+    remaining arguments are as make_rotary
+    
+    returns:             output image (RGBA ndarray), or None if cancelled
+    """
+    
+    fundus_equi, fundus_swapped_resized, lammax, phimax = upstream
+    
+    if is_cancelled(cancel):
         return
     
+    report(progress, Progress.POLAR)
+    
     # produce the polar gore pattern
-    fundus_rotary = make_polar(fundus_swapped_resized, num_gores = num_gores, alpha_limit = alpha_limit, 
-                               projection = projection)
+    fundus_rotary = traced(trace, "polar", make_polar_array, fundus_swapped_resized, num_gores = num_gores, 
+                           alpha_limit = alpha_limit, projection = projection, tile_memory = tile_memory, 
+                           workers = workers, cancel = cancel)
     
-    if QThread.currentThread().isInterruptionRequested():
+    if is_cancelled(cancel):
         return
     
-    if (isinstance(signal, pyqtBoundSignal)):
-        signal.emit(Progress.POLECAP.value)
+    report(progress, Progress.POLECAP)
     
-    # produce the pole cap in the no-cut zone
-    fundus_cap = polecap(fundus_swapped_resized, num_gores = num_gores, phi_cap = phi_no_cut)
+    # produce the pole cap in the no-cut zone, directly from the equirectangular image
+    fundus_cap = traced(trace, "polecap", polecap_from_equi_array, fundus_equi, num_gores = num_gores, lam_extent = lammax, 
+                        phi_extent = phimax, phi_cap = phi_no_cut, background_colour = background_colour)
     
-    if QThread.currentThread().isInterruptionRequested():
+    if is_cancelled(cancel):
         return
     
+    return traced(trace, "paste", paste_polecap, fundus_rotary, fundus_cap)
+
+
+def paste_polecap(fundus_rotary, fundus_cap):
+    """
+    paste_polecap       paste the pole cap over the centre of the polar gore 
+                        pattern, in place
+    
+    fundus_rotary:      polar gore pattern (RGBA ndarray, modified in place)
+    fundus_cap:         pole cap (RGBA ndarray)
+    
+    returns:            output image (RGBA ndarray, the same array as 
+                        fundus_rotary)
+    """
+    
     # caculate offsets to ensure that the centre of fundus_cap is over the centre of
     # fundus_rotary. In each case this is just the distance to move the top/left corner
     # down and to the right.
-    vertical_offset = round((fundus_rotary.height - fundus_cap.height) / 2)
-    horizontal_offset = round((fundus_rotary.width - fundus_cap.width) / 2)
-    fundus_rotary.paste(fundus_cap, (horizontal_offset, vertical_offset), fundus_cap)
+    cap_height, cap_width = fundus_cap.shape[:2]
+    vertical_offset = round((fundus_rotary.shape[0] - cap_height) / 2)
+    horizontal_offset = round((fundus_rotary.shape[1] - cap_width) / 2)
+    
+    # blend the cap over the pattern through the cap's own transparency, 
+    # clipped (as PIL pastes) to the pattern
+    top, left = max(0, vertical_offset), max(0, horizontal_offset)
+    bottom = min(fundus_rotary.shape[0], vertical_offset + cap_height)
+    right = min(fundus_rotary.shape[1], horizontal_offset + cap_width)
+    cap = fundus_cap[top - vertical_offset : bottom - vertical_offset, left - horizontal_offset : right - horizontal_offset]
+    alpha_blend(fundus_rotary[top : bottom, left : right], cap, cap[..., 3:])
     
     return fundus_rotary
 
 
-def make_rotary_adjusted(image_path, alpha_max, num_gores, phi_no_cut, rotation, quality, alpha_limit=mt.pi, projection=Projection.CASSINI, background_colour=(0, 0, 0, 0), im=None):
+def adjust_image(image, quality, background_colour = (0, 0, 0, 0)):
+    """
+    adjust_image        prepare an image for make_rotary, applying the desired
+                        quality (rotation is applied by make_rotary itself)
+    
+    image:              input image path (string), decoded at the desired 
+                        quality, or image (ndarray)
+    
+    remaining arguments are as make_rotary_adjusted
+    
+    returns:            RGB image (ndarray)
+    """
+    
+    # Apply quality resizing
+    if isinstance(image, str):
+        im = image_from_path(image, float(quality / 100))
+    else:
+        im = deres_image(image, float(quality / 100))
+
+    # Ensure the image has the correct background color for JPEG
+    return rgb_with_background(im, background_colour)
+
+
+def estimate_memory(ht, wd, phi_no_cut, mode = Mode.STAGED, tile_memory = TILE_MEMORY, decoded = 0):
+    """
+    estimate_memory:    estimate the peak memory allocated by make_rotary, as 
+                        the largest total, over its stages, of the images alive
+                        during the stage and the working memory of its maps.
+                        Whole maps are compiled and kept in map_cache, while in
+                        TILED mode only a band of the maps is made at a time.
+    
+    ht:                 height of the fundus image, at the desired quality 
+                        (integer)
+    wd:                 width of the fundus image, at the desired quality 
+                        (integer)
+    phi_no_cut:         angle of "no-cut zone" (radians)
+    mode:               rendering mode (Mode class)
+    tile_memory:        memory budget for the maps in TILED mode (bytes)
+    decoded:            number of pixels decoded from the image file, or 0 if
+                        the image is given as an array (integer)
+    
+    returns:            estimated peak (bytes)
+    """
+    
+    # the equirectangular image is transposed with respect to the fundus, and 
+    # the gore net is twice as high as it
+    n, net = ht * wd, 4 * wd * wd
+    radius = int(phi_no_cut * wd / mt.pi) + 2
+    cap = 4 * radius * radius
+    adjust = 3 * decoded + 6 * n
+    
+    if mode == Mode.COMPOSITE:
+        return max(adjust, 3 * n + COMPOSITE_BYTES_PER_PIXEL * net)
+    
+    # the bands of the maps take about an eighth more than their budget
+    def maps(bytes_per_pixel, pixels):
+        if mode == Mode.TILED:
+            return min(tile_memory * 9 // 8, bytes_per_pixel * pixels)
+        return (bytes_per_pixel + 6) * pixels
+    
+    def cached(pixels):
+        return 0 if mode == Mode.TILED else min(6 * pixels, map_cache.max_bytes)
+    
+    # the fundus and the equirectangular image (3 bytes per pixel each) live 
+    # throughout; the swapped image (3) and its doubled width (6) stay pooled 
+    # once the doubled image has its transparency (8), and the gores (8) 
+    # stay pooled once the net (16 per pixel of the equirectangular image) is 
+    # made from them
+    stages = (adjust,
+              6 * n + maps(EQUI_BYTES_PER_PIXEL, n),
+              9 * n + cached(n) + maps(SWAP_BYTES_PER_PIXEL, n),
+              23 * n + cached(2 * n),
+              31 * n + cached(2 * n) + maps(EQUATORIAL_BYTES_PER_PIXEL, 2 * n),
+              31 * n + 4 * net + cached(4 * n) + maps(POLAR_BYTES_PER_PIXEL, net),
+              35 * n + 4 * net + cached(4 * n + net) + (POLAR_BYTES_PER_PIXEL + 10) * cap)
+    
+    return max(stages)
+
+
+def plan_memory(shape, quality, phi_no_cut, max_memory, mode = Mode.STAGED, tile_memory = TILE_MEMORY, 
+                from_file = False):
+    """
+    plan_memory:        choose how to run make_rotary so that its estimated 
+                        peak memory fits within a budget: as requested if it
+                        fits, otherwise in TILED mode with the maps given the
+                        memory the images leave, otherwise at a lower quality
+    
+    shape:              height and width of the fundus image at full quality
+                        (tuple of integers)
+    quality:            desired quality (percentage)
+    phi_no_cut:         angle of "no-cut zone" (radians)
+    max_memory:         memory budget (bytes)
+    mode:               desired rendering mode (Mode class)
+    tile_memory:        desired memory budget for the maps in TILED mode 
+                        (bytes)
+    from_file:          whether the image is decoded from a file (boolean)
+    
+    returns:            (
+                         quality (percentage),
+                         mode (Mode class),
+                         tile_memory (bytes),
+                         estimated peak (bytes)
+                         )
+    
+    raises:             MemoryError if the image cannot be made small enough
+    """
+    
+    ht, wd = shape
+    tile_memory = tile_memory or TILE_MEMORY
+    while True:
+        # sizes as adjust_image makes them, decoding a file with the reduction
+        # image_from_path uses
+        scale = float(quality / 100)
+        h, w = (ht, wd) if scale == 1 else (round(scale * ht), round(scale * wd))
+        if min(h, w) < 2:
+            raise MemoryError("cannot render within {0} bytes".format(max_memory))
+        reduction = max(r for r in (1, 2, 4, 8) if r * scale <= 1 or r == 1)
+        decoded = -(-ht // reduction) * -(-wd // reduction) if from_file else 0
+        
+        estimate = estimate_memory(h, w, phi_no_cut, mode, tile_memory, decoded)
+        if estimate <= max_memory:
+            return quality, mode, tile_memory, estimate
+        
+        # work in bands, with the maps taking what the images leave
+        images = estimate_memory(h, w, phi_no_cut, Mode.TILED, 0, decoded)
+        if max_memory - images >= MIN_TILE_MEMORY:
+            tiles = min(tile_memory, (max_memory - images) * 8 // 9)
+            return quality, Mode.TILED, tiles, estimate_memory(h, w, phi_no_cut, Mode.TILED, tiles, decoded)
+        
+        # otherwise lower the quality, the images taking memory in proportion
+        # to their number of pixels
+        fit = quality * mt.sqrt(max(max_memory - MIN_TILE_MEMORY, 0) / images)
+        quality = mt.floor(min(fit, 0.95 * quality) * 10) / 10
+
+
+def make_rotary_adjusted(image_path, alpha_max, num_gores, phi_no_cut, rotation, quality, alpha_limit=mt.pi, projection=Projection.CASSINI, background_colour=(0, 0, 0, 0), im=None, mode=Mode.STAGED, tile_memory=TILE_MEMORY, workers=None, progress=None, cancel=None, trace=None, max_memory=None):
     """
     make_rotary_adjusted      Master function to produce a gore net stitched at
                               the pole, specifying desired quality and rotation.
@@ -526,25 +2759,734 @@ def make_rotary_adjusted(image_path, alpha_max, num_gores, phi_no_cut, rotation,
     alpha_max:          Angular size of the image from the center (radians)
     num_gores:          Number of gores (integer)
     phi_no_cut:         Angle of "no-cut zone" (radians)
-    rotation:           Angle of rotation (radians)
+    rotation:           Angle of rotation (degrees)
     quality:            Image quality (percentage)
     alpha_limit:        Angular extent of gored region
     projection:         Map projection to use (Projection class)
     background_colour:  Background color to use beyond fundus (R, G, B, A tuple)
     im:                 Input PIL image (overrides image_path)
+    mode:               Rendering mode (Mode class)
+    tile_memory:        Memory budget for the maps in TILED mode (bytes)
+    workers:            Number of threads (integer)
+    progress:           Function called with the value of each stage as it starts (callable)
+    cancel:             Token checked during the calculation (CancelToken)
+    trace:              Record of the time and memory taken by each stage (Trace)
+    max_memory:         Memory budget (bytes): if the estimated peak (see estimate_memory) exceeds it, the stages
+                        run in bands or, failing that, at a lower quality, giving a smaller output. How the
+                        budget was met and the measured peak are recorded in trace.memory, with a warning if
+                        the peak exceeds it (None for no budget)
+
+    Returns:            Output image (PIL.Image), or None if cancelled
     """
-    if im is None:
-        im = image_from_path(image_path)
+    # Fit the calculation within the memory budget, measuring its peak
+    if max_memory is not None:
+        if im is not None:
+            shape = im.shape[:2]
+        else:
+            with Image.open(image_path) as f:
+                shape = f.size[::-1]
+        planned_quality, mode, tile_memory, estimate = plan_memory(shape, quality, phi_no_cut, max_memory, mode, 
+                                                                   tile_memory, from_file = im is None)
+        meter = MemoryMeter()
+        try:
+            rotary = make_rotary_adjusted(image_path, alpha_max, num_gores, phi_no_cut, rotation, planned_quality, 
+                                          alpha_limit, projection, background_colour, im, mode, tile_memory, workers, 
+                                          progress, cancel, trace)
+        finally:
+            peak = meter.stop()
+        
+        if trace is not None:
+            trace.memory = dict(max_memory = max_memory, 
+                                estimate = estimate, 
+                                peak = peak, 
+                                quality = quality, 
+                                planned_quality = planned_quality, 
+                                mode = mode.name, 
+                                tile_memory = tile_memory if mode == Mode.TILED else None)
+        if peak > max_memory:
+            import warnings
+            warnings.warn("peak memory of {0} bytes exceeded max_memory of {1} bytes".format(peak, max_memory), 
+                          RuntimeWarning)
+        return rotary
+    
+    # Open the image (or take the one given) and apply quality and background
+    im = traced(trace, "adjust", adjust_image, image_path if im is None else im, quality, background_colour)
+    
+    if is_cancelled(cancel):
+        return
 
-    # Apply quality resizing
-    im = deres_image(im, float(quality / 100))
+    # Continue with the rotary creation process
+    return make_rotary(im, alpha_max, num_gores, phi_no_cut, alpha_limit, projection, background_colour, mode, tile_memory, workers, 
+                       progress, cancel, rotation, trace)
 
-    # Apply rotation if specified
-    if rotation > 0:
-        im = rotate_image(im, rotation)
 
-    # Ensure the image has the correct background color for JPEG
-    im = convert_to_rgb_with_background(Image.fromarray(im), background_colour)
 
-    # Continue with the rotary creation process
-    return make_rotary(np.array(im), alpha_max, num_gores, phi_no_cut, alpha_limit, projection, background_colour)
+class StageGraph:
+    """
+    StageGraph:     the stages of make_rotary_adjusted as a graph, each stage
+                    keeping its latest result, keyed by the arguments it reads
+                    together with the keys of the stages it depends on:
+                    
+                    load -> deres -> background -> equi -> swap -> polar
+                                                    |             |
+                                                    +-> polecap --+-> composite
+                    
+                    where an image given by its path is decoded at the 
+                    desired quality, so that load and deres are one stage
+                    
+                    so that a run only recomputes the stages whose arguments
+                    have changed since they were last computed. Stages that 
+                    completed before a run was cancelled are kept, so the
+                    next run resumes from them.
+    """
+    
+    def __init__(self):
+        self.results = {}
+        self.computed = []
+        self.trace = None
+    
+    def stage(self, name, key, function, *args, **kwargs):
+        """
+        stage:      return the result of a stage, computing it only if its key
+                    has changed since it was last computed
+        
+        name:       name of the stage (string)
+        key:        arguments read by the stage and the stages before it (tuple)
+        function:   function computing the stage, returning None if 
+                    cancelled
+        
+        remaining arguments are passed to function
+        
+        returns:    result of the stage, or None if cancelled
+        """
+        
+        entry = self.results.get(name)
+        if entry is not None and entry[0] == key:
+            return entry[1] if self.trace is None else self.trace.reuse(name, entry[1])
+        
+        result = traced(self.trace, name, function, *args, **kwargs)
+        if result is not None:
+            self.results[name] = (key, result)
+            self.computed.append(name)
+        
+        return result
+    
+    def clear(self):
+        """
+        clear:      discard the results of every stage
+        """
+        
+        self.results.clear()
+    
+    def run(self, image_path, alpha_max, num_gores, phi_no_cut, rotation, quality, alpha_limit=mt.pi, projection=Projection.CASSINI, background_colour=(0, 0, 0, 0), im=None, mode=Mode.STAGED, tile_memory=TILE_MEMORY, workers=None, progress=None, cancel=None, trace=None):
+        """
+        run:        produce the gore net as make_rotary_adjusted, reusing the 
+                    results of any stages whose arguments are unchanged
+        
+        arguments are as make_rotary_adjusted: reused stages are recorded in
+        trace as cached
+        
+        returns:    output image (PIL.Image), or None if cancelled
+        """
+        
+        rotary = self.run_array(image_path, alpha_max, num_gores, phi_no_cut, rotation, quality, alpha_limit, projection, 
+                                background_colour, im, mode, tile_memory, workers, progress, cancel, trace)
+        if rotary is None:
+            return
+        return nd2im(rotary)
+    
+    def run_array(self, image_path, alpha_max, num_gores, phi_no_cut, rotation, quality, alpha_limit=mt.pi, projection=Projection.CASSINI, background_colour=(0, 0, 0, 0), im=None, mode=Mode.STAGED, tile_memory=TILE_MEMORY, workers=None, progress=None, cancel=None, trace=None):
+        """
+        run_array:  produce the gore net as run, without wrapping it in an image
+        
+        arguments are as run
+        
+        returns:    output image (RGBA numpy array), or None if cancelled. In 
+                    STAGED and TILED modes this is the result of the composite
+                    stage, which is reused by later runs, so it must not be 
+                    changed in place
+        """
+        
+        self.computed = []
+        self.trace = trace
+        
+        # the image itself is the key when it is given, otherwise its path and
+        # modification time: the image is then decoded at the desired quality.
+        # A given image is kept as the result of the load stage, so no other 
+        # array can take its id while it is the key, and is fingerprinted, so 
+        # that an image changed in place is (almost always) seen to change
+        if im is None:
+            key = (image_path, os.path.getmtime(image_path), quality)
+            im = self.stage("load", key, image_from_path, image_path, float(quality / 100))
+        else:
+            key = (id(im), image_fingerprint(im))
+            im = self.stage("load", key, lambda : im)
+            key += (quality,)
+            im = self.stage("deres", key, deres_image, im, float(quality / 100))
+        
+        key += (background_colour,)
+        im = self.stage("background", key, rgb_with_background, im, background_colour)
+        
+        if is_cancelled(cancel):
+            return
+        
+        if mode == Mode.COMPOSITE:
+            return make_rotary_composite_array(im, alpha_max, num_gores, phi_no_cut, alpha_limit, projection, 
+                                               background_colour, workers, progress, cancel, rotation, trace)
+        
+        # the maps for each stage are only built a band at a time in TILED mode
+        if mode != Mode.TILED:
+            tile_memory = None
+        
+        report(progress, Progress.EQUI)
+        
+        equi_key = key + (alpha_max, rotation)
+        equi_result = self.stage("equi", equi_key, equi, im, alpha_max, tile_memory, workers, cancel, rotation)
+        
+        if is_cancelled(cancel):
+            return
+        
+        fundus_equi, lammax, phimax = equi_result
+        
+        report(progress, Progress.SWAP)
+        
+        fundus_swapped_resized = self.stage("swap", equi_key, swap_resized, fundus_equi, phimax, lammax, background_colour, 
+                                            tile_memory, workers, cancel)
+        
+        if is_cancelled(cancel):
+            return
+        
+        report(progress, Progress.POLAR)
+        
+        polar_key = equi_key + (num_gores, alpha_limit, projection)
+        fundus_rotary = self.stage("polar", polar_key, make_polar_array, fundus_swapped_resized, num_gores = num_gores, 
+                                   alpha_limit = alpha_limit, projection = projection, tile_memory = tile_memory, 
+                                   workers = workers, cancel = cancel)
+        
+        if is_cancelled(cancel):
+            return
+        
+        report(progress, Progress.POLECAP)
+        
+        polecap_key = equi_key + (num_gores, phi_no_cut)
+        fundus_cap = self.stage("polecap", polecap_key, polecap_from_equi_array, fundus_equi, num_gores = num_gores, lam_extent = lammax, 
+                                phi_extent = phimax, phi_cap = phi_no_cut, background_colour = background_colour)
+        
+        if is_cancelled(cancel):
+            return
+        
+        # paste onto a copy, leaving the polar stage to be reused
+        rotary = self.stage("composite", polar_key + polecap_key, lambda : paste_polecap(fundus_rotary.copy(), fundus_cap))
+        
+        return rotary
+
+
+"""
+Arguments of make_rotary_adjusted on which adjust_image and make_upstream 
+depend, other than those of the stages before them
+"""
+SWEEP_IMAGE_KEYS = ("quality", "background_colour")
+SWEEP_UPSTREAM_KEYS = ("alpha_max", "rotation")
+
+
+def make_rotary_sweep(image, grid, workers = None, cancel = None, trace = None):
+    """
+    make_rotary_sweep   produce the gore net for every combination of a grid of
+                        arguments, preparing the image and running the upstream
+                        stages (see make_upstream) only once for each distinct
+                        set of the arguments they depend on
+    
+    image:              input image path (string) or image (ndarray)
+    grid:               make_rotary_adjusted arguments, each mapped to a list
+                        of values to sweep over (dict), e.g.
+                        
+                        {"alpha_max": [deg2rad(50)], "num_gores": [6, 12, 24], 
+                         "phi_no_cut": [deg2rad(5), deg2rad(10)]}
+                        
+                        quality and rotation default to 100 and 0; mode is 
+                        always STAGED
+    workers:            number of threads (integer, defaults to the number of
+                        CPUs)
+    cancel:             token checked during the calculation: once cancelled,
+                        no further results are yielded (CancelToken)
+    trace:              record of the time and memory taken by the stages of
+                        every combination (Trace)
+    
+    yields:             (
+                         arguments of this combination (dict),
+                         output image (PIL.Image)
+                         ), in the order that they finish
+    """
+    
+    import itertools
+    from concurrent.futures import wait, FIRST_COMPLETED
+    
+    names = list(grid)
+    variants = [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+    
+    defaults = {"quality" : 100, "rotation" : 0, "background_colour" : (0, 0, 0, 0), "alpha_limit" : mt.pi, 
+                "projection" : Projection.CASSINI}
+    full = lambda variant : {**defaults, **variant}
+    image_key = lambda variant : tuple(full(variant)[name] for name in SWEEP_IMAGE_KEYS)
+    upstream_key = lambda variant : tuple(full(variant)[name] for name in SWEEP_UPSTREAM_KEYS)
+    
+    # group the variants by the arguments of each stage
+    groups = {}
+    for variant in variants:
+        groups.setdefault(image_key(variant), {}).setdefault(upstream_key(variant), []).append(variant)
+    
+    def render(upstream, variant):
+        args = full(variant)
+        rotary = make_downstream(upstream, args["num_gores"], args["phi_no_cut"], args["alpha_limit"], 
+                                 args["projection"], args["background_colour"], cancel = cancel, trace = trace)
+        return variant, None if rotary is None else nd2im(rotary)
+    
+    with ThreadPoolExecutor(max_workers = workers or os.cpu_count()) as executor:
+        # prepare the image once for each image key...
+        pending = {executor.submit(traced, trace, "adjust", adjust_image, image, *key) : (adjust_image, key) for key in groups}
+        
+        # ...as each finishes, run the upstream stages once for each upstream key,
+        # and as those finish, fan out the downstream stages for their variants
+        while pending:
+            done, _ = wait(pending, return_when = FIRST_COMPLETED)
+            if is_cancelled(cancel):
+                break
+            for future in done:
+                stage, key = pending.pop(future)
+                if stage == adjust_image:
+                    for upstream in groups[key]:
+                        args = full(groups[key][upstream][0])
+                        pending[executor.submit(make_upstream, future.result(), args["alpha_max"], args["background_colour"], 
+                                                cancel = cancel, rotation = args["rotation"], trace = trace)] = (make_upstream, (key, upstream))
+                elif stage == make_upstream:
+                    for variant in groups[key[0]][key[1]]:
+                        pending[executor.submit(render, future.result(), variant)] = (render, None)
+                else:
+                    yield future.result()
+
+
+"""
+constants: output formats
+"""
+class ExportFormat(Enum):
+    PNG = 0
+    WEBP = 1
+    TIFF = 2
+    TIFF_LZW = 3
+
+
+"""
+File extensions of each output format
+"""
+EXPORT_EXTENSIONS = {ExportFormat.PNG : (".png",), 
+                     ExportFormat.WEBP : (".webp",), 
+                     ExportFormat.TIFF : (".tif", ".tiff"), 
+                     ExportFormat.TIFF_LZW : (".tif", ".tiff")}
+
+
+"""
+Approximate size of the bands of rows encoded in turn when writing PNG (bytes)
+"""
+EXPORT_BAND_BYTES = 4 * 1024 * 1024
+
+
+def export_format(path):
+    """
+    export_format:  return the output format for a file, by its extension;
+                    TIFF files are LZW compressed, and files with an unknown
+                    extension are PNG
+    
+    path:           path to output image (string)
+    
+    returns:        output format (ExportFormat class)
+    """
+    
+    extension = os.path.splitext(path)[1].lower()
+    for fmt in (ExportFormat.WEBP, ExportFormat.TIFF_LZW):
+        if extension in EXPORT_EXTENSIONS[fmt]:
+            return fmt
+    return ExportFormat.PNG
+
+
+def flatten_image(im, colour):
+    """
+    flatten_image:  composite an RGBA image over a solid colour
+    
+    im:             image array, RGBA (ndarray)
+    colour:         colour to composite over (R, G, B)
+    
+    returns:        image array, RGB (ndarray)
+    """
+    
+    rgb = np.empty(im.shape[:2] + (3,), np.uint8)
+    rgb[...] = colour[:3]
+    alpha_blend(rgb, im[..., :3], im[..., 3:])
+    
+    return rgb
+
+
+def png_chunk(kind, data):
+    """
+    png_chunk:      return a PNG chunk: length, type, data and checksum
+    
+    kind:           chunk type (bytes)
+    data:           chunk data (bytes)
+    
+    returns:        chunk (bytes)
+    """
+    
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def write_png(f, im, compression, flatten = None, progress = None):
+    """
+    write_png:      write an image as PNG, encoding it in bands of rows 
+                    straight from the array; every row uses the Sub filter,
+                    which is quick to apply and compresses smooth images well
+    
+    f:              file opened for writing in binary mode
+    im:             image array, RGB or RGBA (ndarray)
+    compression:    zlib compression level, from 0 (none) to 9 (smallest)
+    flatten:        colour over which to composite an RGBA image, writing RGB
+                    (R, G, B), or None to keep any alpha channel
+    progress:       function called with the percentage written (callable, or
+                    None)
+    """
+    
+    h, w = im.shape[:2]
+    channels = 3 if flatten is not None else im.shape[2]
+    colour_type = {3 : 2, 4 : 6}[channels]
+    
+    f.write(b"\x89PNG\r\n\x1a\n")
+    f.write(png_chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, colour_type, 0, 0, 0)))
+    
+    compressor = zlib.compressobj(compression)
+    band = max(1, EXPORT_BAND_BYTES // (w * channels))
+    for y in range(0, h, band):
+        rows = im[y : y + band]
+        if flatten is not None and rows.shape[2] == 4:
+            rows = flatten_image(rows, flatten)
+        rows = rows.reshape(len(rows), w * channels)
+        
+        # each row is its filter type (1: Sub), then the difference of each
+        # byte from the same byte of the pixel to its left
+        filtered = np.empty((len(rows), w * channels + 1), np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1 : channels + 1] = rows[:, : channels]
+        np.subtract(rows[:, channels :], rows[:, : -channels], out = filtered[:, channels + 1 :])
+        
+        data = compressor.compress(filtered)
+        if data:
+            f.write(png_chunk(b"IDAT", data))
+        if progress is not None:
+            progress(round(100 * min(y + band, h) / h))
+            
+    f.write(png_chunk(b"IDAT", compressor.flush()))
+    f.write(png_chunk(b"IEND", b""))
+
+
+def export_image(image, path, fmt = None, compression = 1, flatten = None, progress = None):
+    """
+    export_image:   save an image, by default quickly rather than as small as 
+                    possible
+    
+    image:          image, RGB or RGBA (ndarray, or PIL Image)
+    path:           path to output image (string)
+    fmt:            output format (ExportFormat class), or None to choose by 
+                    the extension of path
+    compression:    compression effort, from 0 (none) to 9 (smallest file);
+                    ignored for TIFF
+    flatten:        colour over which to composite an RGBA image, saving RGB
+                    (R, G, B), or None to keep any alpha channel
+    progress:       function called with the percentage written (callable, or
+                    None)
+    """
+    
+    if fmt is None:
+        fmt = export_format(path)
+    im = np.asarray(image)
+    
+    if fmt == ExportFormat.PNG:
+        with open(path, "wb") as f:
+            write_png(f, im, compression, flatten, progress)
+        return
+    
+    # other formats are encoded by PIL in one go
+    if progress is not None:
+        progress(0)
+    if flatten is not None and im.shape[2] == 4:
+        im = flatten_image(im, flatten)
+    out = Image.fromarray(im)
+    if fmt == ExportFormat.WEBP:
+        out.save(path, "WEBP", lossless = True, exact = True, quality = round(100 * compression / 9), 
+                 method = round(6 * compression / 9))
+    else:
+        out.save(path, "TIFF", compression = "tiff_lzw" if fmt == ExportFormat.TIFF_LZW else None)
+    if progress is not None:
+        progress(100)
+
+
+"""
+Thread on which export_image_async saves images, one at a time
+"""
+export_executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "gore2-export")
+
+
+def export_image_async(image, path, **kwargs):
+    """
+    export_image_async: save an image with export_image on a background 
+                        thread, so that the caller may carry on; the progress
+                        function, if any, is called from that thread
+    
+    image:              image, RGB or RGBA (ndarray, or PIL Image)
+    path:               path to output image (string)
+    kwargs:             further arguments to export_image
+    
+    returns:            future whose result is None once the image is saved,
+                        or which raises any error in saving it (Future)
+    """
+    
+    return export_executor.submit(export_image, image, path, **kwargs)
+
+
+"""
+Angular parameters given in a batch parameter file: as in the application,
+these are full angles in degrees, where gore2 uses angles from the centre in
+radians
+"""
+BATCH_ANGLES = ("alpha_max", "phi_no_cut", "alpha_limit")
+
+
+def read_batch_parameters(path):
+    """
+    read_batch_parameters:  read the make_rotary_adjusted arguments for a batch
+                            from a JSON parameter file, e.g.
+                            
+                            {"alpha_max": 100, "num_gores": 12, 
+                             "phi_no_cut": 20, "rotation": 0, "quality": 100,
+                             "projection": "CASSINI"}
+                            
+                            angles are full angles in degrees, as in the 
+                            application, projection and mode are
+                            given by name, background_colour is an 
+                            (R, G, B, A) list, and max_memory is in bytes
+    
+    path:                   path to the parameter file (string)
+    
+    returns:                keyword arguments for make_rotary_adjusted (dict)
+    """
+    
+    import json
+    
+    with open(path) as f:
+        params = json.load(f)
+    
+    for name in BATCH_ANGLES:
+        if name in params:
+            params[name] = deg2rad(params[name]) / 2
+    if "projection" in params:
+        params["projection"] = Projection[params["projection"]]
+    if "mode" in params:
+        params["mode"] = Mode[params["mode"]]
+    if "background_colour" in params:
+        params["background_colour"] = tuple(params["background_colour"])
+    
+    return params
+
+
+def render_file(input_path, output_path, params, cache_dir = None, trace = False):
+    """
+    render_file:    produce the gore net for a single image and save it as PNG,
+                    reporting rather than raising any failure
+    
+    input_path:     path to the fundus image (string)
+    output_path:    path to the output image (string)
+    params:         keyword arguments for make_rotary_adjusted (dict)
+    cache_dir:      directory of an ImageCache for the decoded image (string, 
+                    or None not to cache it)
+    trace:          whether to record each stage, in the summary as stages 
+                    (see Trace) and as Chrome trace events (boolean)
+    
+    returns:        summary of the render (dict)
+    """
+    
+    import traceback
+    
+    # the render may be in a fresh process, so open the cache here
+    global image_cache
+    if cache_dir is not None and (image_cache is None or image_cache.directory != cache_dir):
+        image_cache = ImageCache(cache_dir)
+    
+    start = time.perf_counter()
+    record = {"input": input_path, "output": output_path}
+    stages = Trace() if trace or params.get("max_memory") is not None else None
+    try:
+        rotary = make_rotary_adjusted(input_path, **params, trace = stages)
+        traced(stages, "export", export_image, rotary, output_path, ExportFormat.PNG)
+        record["status"] = "done"
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = "".join(traceback.format_exception_only(type(e), e)).strip()
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    if trace:
+        record["stages"] = stages.records
+        record["events"] = stages.events()
+    if stages is not None and stages.memory is not None:
+        record["memory"] = stages.memory
+    
+    return record
+
+
+def output_paths(inputs, output_dir):
+    """
+    output_paths:   name the PNG output of each image after its stem, but where
+                    images share a stem, mirror their directories relative to 
+                    one another, adding the extension where they share a 
+                    directory too, so that no output overwrites another
+    
+    inputs:         image paths (sequence of strings)
+    output_dir:     directory for the PNG outputs (string)
+    
+    returns:        output paths, in the order of inputs (list of strings)
+    """
+    
+    # group the images by stem
+    groups = {}
+    for input_path in inputs:
+        stem, ext = os.path.splitext(os.path.basename(input_path))
+        groups.setdefault(stem, []).append(os.path.dirname(os.path.abspath(input_path)))
+    
+    names = []
+    for input_path in inputs:
+        stem, ext = os.path.splitext(os.path.basename(input_path))
+        directories = groups[stem]
+        name = stem
+        if len(directories) > 1:
+            directory = os.path.dirname(os.path.abspath(input_path))
+            name = os.path.normpath(os.path.join(os.path.relpath(directory, os.path.commonpath(directories)), stem))
+            if directories.count(directory) > 1:
+                name += "_" + ext.lstrip(".")
+        names.append(name)
+    
+    # anything still the same (as when an image is given twice) is numbered
+    seen = set()
+    for i, name in enumerate(names):
+        unique, n = name, 1
+        while unique in seen:
+            n += 1
+            unique = "{}_{}".format(name, n)
+        seen.add(unique)
+        names[i] = unique
+    
+    return [os.path.join(output_dir, name + ".png") for name in names]
+
+
+def batch(inputs, param_path, output_dir, processes = None, force = False, cache_dir = None, trace = False):
+    """
+    batch:          produce gore nets for many images on a pool of processes,
+                    skipping any output newer than both its image and the 
+                    parameter file, and carrying on past any failure
+    
+    inputs:         image paths (sequence of strings)
+    param_path:     path to the JSON parameter file (string)
+    output_dir:     directory for the PNG outputs (string)
+    processes:      number of processes (integer, defaults to the number of 
+                    CPUs)
+    force:          render even if the output is up to date (boolean)
+    cache_dir:      directory of an ImageCache for the decoded images (string,
+                    or None not to cache them)
+    trace:          whether to record each stage of each render (boolean, see
+                    render_file)
+    
+    returns:        summary of each render, in the order of inputs (list of 
+                    dict)
+    """
+    
+    import traceback
+    from concurrent.futures import ProcessPoolExecutor
+    
+    params = read_batch_parameters(param_path)
+    os.makedirs(output_dir, exist_ok = True)
+    
+    outputs = output_paths(inputs, output_dir)
+    records, pending = [], {}
+    with ProcessPoolExecutor(max_workers = processes) as executor:
+        for input_path, output_path in zip(inputs, outputs):
+            os.makedirs(os.path.dirname(output_path), exist_ok = True)
+            newest = max(os.path.getmtime(input_path), os.path.getmtime(param_path))
+            if not force and os.path.exists(output_path) and os.path.getmtime(output_path) >= newest:
+                records.append({"input": input_path, "output": output_path, "status": "skipped", "seconds": 0})
+            else:
+                records.append(None)
+                pending[len(records) - 1] = executor.submit(render_file, input_path, output_path, params, cache_dir, trace)
+        
+        # a process that dies (as when it runs out of memory) breaks the pool
+        # and fails every render left, but the others are still recorded
+        for i, future in pending.items():
+            try:
+                records[i] = future.result()
+            except Exception as e:
+                records[i] = {"input": inputs[i], "output": outputs[i], "status": "failed", 
+                              "error": "".join(traceback.format_exception_only(type(e), e)).strip(), "seconds": 0}
+            print("{status:8} {seconds:8.3f}s  {input}".format(**records[i]), flush = True)
+    
+    return records
+
+
+def main(argv = None):
+    """
+    main:       command line entry point: python -m gore2 INPUT... -p PARAMS
+    
+    argv:       command line arguments (list of strings, defaults to sys.argv)
+    
+    returns:    exit status, 1 if any image failed (integer)
+    """
+    
+    import argparse
+    import glob
+    import json
+    
+    parser = argparse.ArgumentParser(prog = "python -m gore2", 
+                                     description = "Produce gore nets for a batch of fundus images.")
+    parser.add_argument("inputs", nargs = "+", help = "image files, directories or glob patterns")
+    parser.add_argument("-p", "--params", required = True, help = "JSON parameter file")
+    parser.add_argument("-o", "--output", default = "output", help = "output directory (default: output)")
+    parser.add_argument("-j", "--processes", type = int, default = None, help = "number of processes (default: number of CPUs)")
+    parser.add_argument("-s", "--summary", default = None, help = "JSON summary file (default: OUTPUT/summary.json)")
+    parser.add_argument("-f", "--force", action = "store_true", help = "render even if the output is up to date")
+    parser.add_argument("-c", "--cache", nargs = "?", const = IMAGE_CACHE_DIR, default = None, metavar = "DIR", 
+                        help = "cache decoded images, for quicker reruns (default DIR: {})".format(IMAGE_CACHE_DIR))
+    parser.add_argument("-t", "--trace", default = None, metavar = "FILE", 
+                        help = "record the stages of each render in the summary, and write them to FILE as a Chrome trace")
+    args = parser.parse_args(argv)
+    
+    # expand directories and glob patterns
+    inputs = []
+    for pattern in args.inputs:
+        if os.path.isdir(pattern):
+            inputs += sorted(os.path.join(pattern, name) for name in os.listdir(pattern) 
+                             if os.path.isfile(os.path.join(pattern, name)))
+        else:
+            inputs += sorted(glob.glob(pattern)) or [pattern]
+    for path in inputs:
+        if not os.path.exists(path):
+            parser.error("no such file: {}".format(path))
+    
+    records = batch(inputs, args.params, args.output, args.processes, args.force, args.cache, args.trace is not None)
+    
+    if args.trace:
+        save_trace_events(args.trace, [event for r in records for event in r.pop("events", [])])
+    
+    summary = args.summary or os.path.join(args.output, "summary.json")
+    with open(summary, "w") as f:
+        json.dump(records, f, indent = 2)
+    
+    counts = {status : sum(r["status"] == status for r in records) for status in ("done", "skipped", "failed")}
+    print("{done} done, {skipped} skipped, {failed} failed; summary in {0}".format(summary, **counts))
+    
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
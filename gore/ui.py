@@ -20,6 +20,9 @@ import numpy
 from nbutils import fig
 from matplotlib import colors
 
+# keep decoded images on disk, so that re-goring an image is quick
+gore2.image_cache = gore2.ImageCache()
+
 class Timer:
     def __init__(self, timeout, callback):
         self._timeout = timeout
@@ -157,19 +160,20 @@ btn_calculate = widgets.Button(
 )
 
 def get_inputs():
+    # images from a file are left to gore2 to open, at the desired quality
+    im_path, im = None, None
     if (w_source_img.value == use_upload_text):
         for name, file_info in w_file_upload.value.items():
             pil_image = Image.open(io.BytesIO(file_info['content']))
         im = numpy.array(pil_image) 
     else:
         im_path = join(mypath, w_source_img.value)
-        im = gore2.image_from_path(im_path)
         
     rgba = colors.to_rgba(w_background_colour.value)
     rgba_scaled = tuple(round(x * 255) for x in rgba)
         
     inputs = dict(
-                image_path = None, 
+                image_path = im_path, 
                 alpha_max = gore2.deg2rad(w_alpha_max.value) / 2, 
                 num_gores = w_num_gores.value,
                 phi_no_cut = gore2.deg2rad(w_phi_no_cut.value) / 2,
@@ -188,7 +192,7 @@ def calculate(gore_args, allow_save=False):
     fig(rotary)
 
     if (allow_save):
-        rotary.save("output.png")
+        gore2.export_image(rotary, "output.png")
         local_file = FileLink('./output.png', result_html_prefix="Click here to download: ")
         display(local_file)
 
@@ -24,16 +24,15 @@ from PyQt5.QtWidgets import (QApplication,
                              QTextEdit,
                              qApp)
 from PyQt5.QtWidgets import QMessageBox as qm
-from PyQt5.QtGui import QPixmap, QKeySequence, QColor, QIcon
+from PyQt5.QtGui import QPixmap, QImage, QKeySequence, QColor, QIcon
 from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal, QTimer, QFile, QTextStream
-import qtawesome as qta
 
-import logging, sys, os
+import logging, sys, os, tempfile
+import numpy as np
 sys.path.append("../gore")
 import gore2
-from PIL.ImageQt import ImageQt
 from enum import Enum
-from numpy import pi
+from math import pi
 from time import perf_counter
 
 # Tuple to store major, minor and revision numbers
@@ -88,6 +87,26 @@ def deg2rad(x):
     
     return x / 180 * pi
 
+# file dialog filters for each output format
+exportFilters = {"PNG image (*.png)" : gore2.ExportFormat.PNG,
+                 "WebP image, lossless (*.webp)" : gore2.ExportFormat.WEBP,
+                 "TIFF image, LZW compressed (*.tif *.tiff)" : gore2.ExportFormat.TIFF_LZW,
+                 "TIFF image, uncompressed (*.tif *.tiff)" : gore2.ExportFormat.TIFF}
+
+def ndarray_to_qimage(image):
+    """
+    ndarray_to_qimage:  wrap an RGB or RGBA image array as a QImage, without
+                        copying it: the array must outlive the QImage
+
+    image:              image array, C-contiguous (ndarray)
+    
+    returns:            image (QImage)
+    """
+    
+    h, w, channels = image.shape
+    imageFormat = QImage.Format_RGBA8888 if channels == 4 else QImage.Format_RGB888
+    return QImage(image.data, w, h, image.strides[0], imageFormat)
+
 def get_data_file_path(fileName):
     if getattr(sys, 'frozen', False):
         # application is frozen
@@ -157,9 +176,10 @@ class ImageLabel(QLabel):
     def heightForWidth(self, width):
         return width
 
-    def setPixmap(self, image):
+    def setImage(self, image):
+        # show an image array or QImage: only a proxy at the size of the window
+        # is kept, so the full-resolution image is scaled just once
         self.clear()
-        super().setPixmap(image)
         growthCorrectionInPixels = 4
         w = super().width() - growthCorrectionInPixels
         h = super().height() - growthCorrectionInPixels
@@ -167,7 +187,10 @@ class ImageLabel(QLabel):
         super().setScaledContents(1)
 
         # set a scaled pixmap to a w x h window keeping its aspect ratio
-        super().setPixmap(image.scaled(w, h, Qt.KeepAspectRatio))
+        if not isinstance(image, QImage):
+            image = ndarray_to_qimage(image)
+        proxy = image.scaled(w, h, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        super().setPixmap(QPixmap.fromImage(proxy))
         
     def clearPixmap(self):
         self.clear()
@@ -207,6 +230,19 @@ class MainWindow(QMainWindow):
         self.thread = None
         self.worker = None
         
+        # images being saved, as (thread, export worker) pairs
+        self.exports = []
+        
+        # Chrome trace events of every calculation, when debugging
+        self.traceEvents = []
+        
+        # stages of the calculation, kept between runs so that only the stages
+        # affected by changed inputs are recalculated
+        self.stageGraph = gore2.StageGraph()
+        
+        # keep decoded images on disk, so that reopening an image is quick
+        gore2.image_cache = gore2.ImageCache()
+        
         # allow drap & drop
         self.setAcceptDrops(True)
 
@@ -238,6 +274,7 @@ class MainWindow(QMainWindow):
         self.imagePath = None
         self.backgroundColour = QColor("white") # persistent, never reset; lost on exit
         self.outputPath = None
+        self.outputFormat = None
         
         # control labels
         self.fundusImageSizeLabel = QLabel("")
@@ -378,7 +415,9 @@ class MainWindow(QMainWindow):
         fileMenu = menubar.addMenu('&File')
         helpMenu = menubar.addMenu('&Help')
         
-        # create the icons
+        # create the icons: qtawesome is imported here, once the splash screen
+        # is showing, since it is slow to load
+        import qtawesome as qta
         openIcon = qta.icon('mdi.folder-open')
         saveIcon = qta.icon('mdi.content-save')
         saveAsIcon = qta.icon('mdi.content-save-edit')
@@ -454,14 +493,19 @@ class MainWindow(QMainWindow):
             return False
     
     def save_output_dialog(self):
-        # returns true if an image was saved successfuly
-        fileFilter = "Image files (*.jpg *.gif *.png *.bmp *.tiff)"
-        fileName, _ = QFileDialog.getSaveFileName(self,
-                                                  'Save file',
-                                                  os.getcwd(),
-                                                  fileFilter)
+        # returns true if saving an image was started successfuly
+        fileFilter = ";;".join(exportFilters)
+        fileName, selectedFilter = QFileDialog.getSaveFileName(self,
+                                                               'Save file',
+                                                               os.getcwd(),
+                                                               fileFilter)
         if (fileName != ""):
+            exportFormat = exportFilters.get(selectedFilter, gore2.export_format(fileName))
+            extensions = gore2.EXPORT_EXTENSIONS[exportFormat]
+            if (os.path.splitext(fileName)[1].lower() not in extensions):
+                fileName = fileName + extensions[0]
             self.outputPath = fileName
+            self.outputFormat = exportFormat
             return self.save_output()
         else:
             return False
@@ -483,7 +527,48 @@ class MainWindow(QMainWindow):
                 self.backgroundColour = colour
     
     def save_output(self):
-        return self.worker.outputPixmap.save(self.outputPath, "PNG")
+        # save on a background thread, so that the user can carry on working:
+        # returns true once saving has started
+        thread = QThread()
+        exportWorker = ExportWorker(self.worker.outputImage, self.outputPath, self.outputFormat)
+        exportWorker.moveToThread(thread)
+        thread.started.connect(exportWorker.run)
+        exportWorker.finished.connect(thread.quit)
+        exportWorker.finished.connect(exportWorker.deleteLater)
+        exportWorker.progress.connect(self.export_progress_handler)
+        thread.finished.connect(thread.deleteLater)
+        thread.finished.connect(lambda: self.export_complete_handler(thread, exportWorker))
+        self.exports.append((thread, exportWorker))
+        thread.start()
+        return True
+    
+    def export_progress_handler(self, i):
+        self.statusBar.showMessage("Saving: {0}%".format(i))
+        
+    def export_complete_handler(self, thread, exportWorker):
+        self.exports.remove((thread, exportWorker))
+        if (exportWorker.error == None):
+            logging.debug("Saved {0} in {1:.4f}s".format(exportWorker.path, exportWorker.time))
+            self.statusBar.showMessage("Saved {0}".format(exportWorker.path), 5000)
+            return
+        
+        # the save failed: if it was the latest, the changes are unsaved again
+        logging.debug("Saving {0} FAILED: {1}".format(exportWorker.path, exportWorker.error))
+        self.statusBar.clearMessage()
+        if (exportWorker.path == self.outputPath):
+            if (self.state == State.SAVED_CHANGES):
+                self.transition(State.UNSAVED_CHANGES)
+            elif (self.state == State.CALCULATING_SAVED_CHANGES):
+                self.transition(State.CALCULATING_UNSAVED_CHANGES)
+            elif (self.state == State.CANCELLING_SAVED_CHANGES):
+                self.transition(State.CANCELLING_UNSAVED_CHANGES)
+            self.update_widgets()
+        qm.warning(self, 'Save', "Could not save {0}: {1}".format(exportWorker.path, exportWorker.error))
+        
+    def wait_for_exports(self):
+        # let any images being saved finish before exiting
+        for thread, _ in self.exports:
+            thread.wait()
     
     def start_calculating(self):
         self.runLongTask()
@@ -818,13 +903,13 @@ class MainWindow(QMainWindow):
             self.transition(State.CALCULATING_SAVED_CHANGES)
             self.start_calculating()
         elif (self.state == State.CALCULATING): # cancel requested
-            self.thread.requestInterruption()
+            self.worker.cancel.cancel()
             self.transition(State.CANCELLING)
         elif (self.state == State.CALCULATING_UNSAVED_CHANGES): #cancel requested
-            self.thread.requestInterruption()
+            self.worker.cancel.cancel()
             self.transition(State.CANCELLING_UNSAVED_CHANGES)
         elif (self.state == State.CALCULATING_SAVED_CHANGES): #cancel requested
-            self.thread.requestInterruption()
+            self.worker.cancel.cancel()
             self.transition(State.CANCELLING_SAVED_CHANGES)
         elif (self.state == State.CANCELLING or
               self.state == State.CANCELLING_UNSAVED_CHANGES or
@@ -840,6 +925,8 @@ class MainWindow(QMainWindow):
         self.update_widgets()
             
     def calculation_complete_forwarder(self):
+        if (self.worker.trace != None):
+            self.save_trace(self.worker.trace)
         # forward calls from thread.finished() depending on whether calculation
         # completed or was cancelled
         if (self.worker.complete):
@@ -847,6 +934,17 @@ class MainWindow(QMainWindow):
         else:
             self.calculation_cancelled_handler()
             
+    def save_trace(self, trace):
+        # log the stages of a calculation, and add them to the trace of the 
+        # session, which may be opened in chrome://tracing or ui.perfetto.dev
+        for record in trace.records:
+            logging.debug("Stage {name}: {wall:.4f}s, CPU {cpu:.4f}s, shape {shape}{0}".format(
+                          " (cached)" if record["cached"] else "", **record))
+        self.traceEvents += trace.events()
+        tracePath = os.path.join(tempfile.gettempdir(), "gore-trace.json")
+        gore2.save_trace_events(tracePath, self.traceEvents)
+        logging.debug("Trace written to {0}".format(tracePath))
+            
     def progress_handler(self, i):
         logging.debug ("Calculation progress: {0}".format(i))
         if (i == 0):
@@ -871,7 +969,7 @@ class MainWindow(QMainWindow):
         elif (self.state == State.CALCULATING or
               self.state == State.CALCULATING_UNSAVED_CHANGES or
               self.state == State.CALCULATING_SAVED_CHANGES):
-            self.previewImageLabel.setPixmap(self.worker.outputPixmap)
+            self.previewImageLabel.setImage(self.worker.outputImage)
             self.transition(State.UNSAVED_CHANGES)
         elif (self.state == State.START or
               self.state == State.END):
@@ -995,14 +1093,20 @@ class MainWindow(QMainWindow):
             event.ignore()
 
     def set_image(self, file_path):
+        # the preview is decoded by Qt: the calculation decodes (and caches)
+        # the image itself, at the scale given by the quality
+        image = QImage(file_path)
+        if image.isNull():
+            return False
         self.imagePath = file_path
-        self.previewImageLabel.setPixmap(QPixmap(file_path))
-        return True # todo return success
+        self.previewImageLabel.setImage(image)
+        return True
     
     def clear_image(self):
         self.imagePath = None
         self.outputPath = None
         self.previewImageLabel.clearPixmap()
+        self.stageGraph.clear()
         
     def get_inputs(self):
         # collect the inputs to the calculation as a dict
@@ -1021,7 +1125,7 @@ class MainWindow(QMainWindow):
         # Step 2: Create a QThread object
         self.thread = QThread()
         # Step 3: Create a worker object
-        self.worker = Worker(self.get_inputs())
+        self.worker = Worker(self.get_inputs(), self.stageGraph)
         # Step 4: Move worker to the thread
         self.worker.moveToThread(self.thread)
         # Step 5: Connect signals and slots
@@ -1044,31 +1148,60 @@ class Worker(QObject):
     finished = pyqtSignal()
     progress = pyqtSignal(int)
     
-    def __init__(self, inputs = None):
+    def __init__(self, inputs = None, stageGraph = None):
         QObject.__init__(self)
         self.complete = True
         self.inputs = inputs
+        self.stageGraph = stageGraph if stageGraph is not None else gore2.StageGraph()
+        self.cancel = gore2.CancelToken()
+        # record the stages when debugging
+        self.trace = gore2.Trace() if logging.getLogger().isEnabledFor(logging.DEBUG) else None
 
     def run(self):
         """This is where we do the goring"""
-        gore2.signal = self.progress
         tic = perf_counter()
-        im = gore2.make_rotary_adjusted(**self.inputs)
+        im = self.stageGraph.run_array(**self.inputs, progress = self.progress.emit, cancel = self.cancel, trace = self.trace)
         toc = perf_counter()
         time = toc - tic
-        if (im == None):
+        logging.debug("Calculated stages: {0}".format(", ".join(self.stageGraph.computed)))
+        if im is None:
             logging.debug("Calculation CANCELLED after {0:4f}".format(time))
             self.complete = False
         else:
             logging.debug("Calculation COMPLETED in {0:.4f}s".format(time) )
-            qim = ImageQt(im)
-            pix = QPixmap.fromImage(qim)
-            logging.debug("Returned image has size {0}px x {1}px".format(pix.width(), pix.height()))
-            self.outputPixmap = pix
+            # the full-resolution RGBA array, kept for saving without a copy;
+            # the preview is made from it on the GUI thread
+            self.outputImage = im
+            logging.debug("Returned image has size {0}px x {1}px".format(self.outputImage.shape[1], self.outputImage.shape[0]))
+        
+        self.finished.emit()
+
+# Worker class for saving images
+class ExportWorker(QObject):
+    
+    finished = pyqtSignal()
+    progress = pyqtSignal(int)
+    
+    def __init__(self, image, path, exportFormat = None):
+        QObject.__init__(self)
+        self.image = image
+        self.path = path
+        self.exportFormat = exportFormat
+        self.error = None
+        self.time = 0
         
+    def run(self):
+        """This is where we save the image"""
+        tic = perf_counter()
+        try:
+            gore2.export_image(self.image, self.path, self.exportFormat, progress = self.progress.emit)
+        except Exception as e:
+            self.error = str(e)
+        self.time = perf_counter() - tic
         self.finished.emit()
 
 def main():
+    tic = perf_counter()
     app = QApplication(sys.argv)
     splash_path = get_data_file_path("resources/splash.png")
     pixmap = QPixmap(splash_path)
@@ -1080,14 +1213,25 @@ def main():
     loadingString = "loading..."
     splash.showMessage(loadingString)
     
+    window = MainWindow()
+    window.resize(600,400)
+    
     loadingString += ("ready")
     splash.showMessage(loadingString)
     
-    window = MainWindow()
-    # close the splash screen after waiting 1s (in addition to load time)
-    QTimer.singleShot(1000, lambda: splash.finish(window))
-    window.resize(600,400)
+    # ...and close it as soon as the window is ready
     window.show()
+    splash.finish(window)
+    app.aboutToQuit.connect(window.wait_for_exports)
+    logging.debug("Window shown {0:.4f}s after starting".format(perf_counter() - tic))
+    
+    # once the window is showing, load the rest of gore2 so that the first
+    # calculation does not wait for it
+    QTimer.singleShot(0, gore2.preload)
+    
+    # exit once ready, when measuring the startup time
+    if (os.environ.get("GORE_EXIT_WHEN_READY")):
+        QTimer.singleShot(0, app.quit)
     
     sys.exit( app.exec_() )
     
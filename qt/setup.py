@@ -11,9 +11,10 @@ from cx_Freeze import setup, Executable
 
 sys.path.append("../gore")
 
-# Dependencies are automatically detected, but it might need fine tuning.
+# Dependencies are automatically detected, but it might need fine tuning: gore2
+# imports some modules lazily, by name, so these must be included explicitly
 build_exe_options = {
-    "includes": ["gore2"], 
+    "includes": ["gore2", "cv2", "PIL.Image", "scipy.ndimage"], 
     "include_files": ["resources/", 
                       "icon.icns", 
                       "icon.ico", 
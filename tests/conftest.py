@@ -0,0 +1,5 @@
+import os
+import sys
+
+# gore2 is a single module living in gore/, rather than an installed package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gore"))
@@ -0,0 +1,43 @@
+import json
+import os
+import shutil
+
+import gore2
+
+
+IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "img", "img1.jpg")
+
+
+def test_output_paths_unique_stems():
+    assert gore2.output_paths(["a/x.jpg", "b/y.png"], "out") == [os.path.join("out", "x.png"), os.path.join("out", "y.png")]
+
+
+def test_output_paths_mirror_directories():
+    outputs = gore2.output_paths(["a/fundus.jpg", "b/c/fundus.jpg", "d/other.jpg"], "out")
+    assert outputs == [os.path.join("out", "a", "fundus.png"), 
+                       os.path.join("out", "b", "c", "fundus.png"), 
+                       os.path.join("out", "other.png")]
+
+
+def test_output_paths_add_extension():
+    outputs = gore2.output_paths(["a/x.jpg", "a/x.png", "b/x.jpg", "a/x.jpg"], "out")
+    assert len(set(outputs)) == 4
+    assert outputs[:3] == [os.path.join("out", "a", "x_jpg.png"), 
+                           os.path.join("out", "a", "x_png.png"), 
+                           os.path.join("out", "b", "x.png")]
+
+
+def test_batch_same_stems(tmp_path):
+    for directory in ("a", "b"):
+        os.makedirs(tmp_path / directory)
+        shutil.copy(IMAGE, tmp_path / directory / "fundus.jpg")
+    params = tmp_path / "params.json"
+    params.write_text(json.dumps({"alpha_max": 80, "num_gores": 6, "phi_no_cut": 20, "rotation": 0, "quality": 10}))
+    
+    inputs = [str(tmp_path / "a" / "fundus.jpg"), str(tmp_path / "b" / "fundus.jpg")]
+    records = gore2.batch(inputs, str(params), str(tmp_path / "out"), processes = 2)
+    
+    assert [r["status"] for r in records] == ["done", "done"]
+    assert sorted(r["output"] for r in records) == [str(tmp_path / "out" / "a" / "fundus.png"), 
+                                                    str(tmp_path / "out" / "b" / "fundus.png")]
+    assert all(os.path.exists(r["output"]) for r in records)
@@ -0,0 +1,66 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GORE_DIR = os.path.join(ROOT, "gore")
+
+
+# many renders at once on a pool of threads, in each mode, from a fresh 
+# interpreter, followed by renders that are cancelled part way through
+STRESS = """
+import json, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import gore2
+
+im = gore2.image_from_path({image!r})
+args = dict(image_path = None, im = im, alpha_max = gore2.deg2rad(40), num_gores = 12, 
+            phi_no_cut = gore2.deg2rad(10), rotation = 0, quality = 60)
+variants = [dict(), dict(mode = gore2.Mode.TILED, tile_memory = 1 << 20), dict(workers = 3), 
+            dict(mode = gore2.Mode.COMPOSITE)]
+
+with ThreadPoolExecutor(16) as executor:
+    outputs = list(executor.map(lambda i : np.asarray(gore2.make_rotary_adjusted(**args, **variants[i % 4])), range(64)))
+references = [np.asarray(gore2.make_rotary_adjusted(**args, **variant)) for variant in variants]
+identical = [bool(np.array_equal(output, references[i % 4])) for i, output in enumerate(outputs)]
+
+cancels = []
+for variant in variants:
+    gore2.map_cache.clear()
+    token = gore2.CancelToken()
+    result = []
+    thread = threading.Thread(target = lambda : result.append(gore2.make_rotary_adjusted(**dict(args, quality = 100), **variant, 
+                                                                                       cancel = token)))
+    thread.start()
+    time.sleep(0.05)
+    start = time.perf_counter()
+    token.cancel()
+    thread.join()
+    cancels.append(dict(variant = repr(variant), cancelled = result[0] is None, latency = time.perf_counter() - start))
+
+print(json.dumps(dict(identical = identical, cancels = cancels)))
+"""
+
+
+@pytest.fixture(scope = "module")
+def stress():
+    script = STRESS.format(image = os.path.join(ROOT, "img", "img1.jpg"))
+    result = subprocess.run([sys.executable, "-c", script], cwd = GORE_DIR, capture_output = True, text = True)
+    assert result.returncode == 0, result.stderr
+    
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_concurrent_renders_identical(stress):
+    assert all(stress["identical"])
+
+
+def test_cancel_stops_quickly(stress):
+    for cancel in stress["cancels"]:
+        assert cancel["cancelled"], cancel
+        assert cancel["latency"] < 0.25, cancel
@@ -0,0 +1,60 @@
+import math as mt
+
+import numpy as np
+import pytest
+
+import gore2
+from gore2 import Projection
+
+
+TOLERANCE = 0.003
+
+
+def direct_maps(h, w, num_gores, phi_cap, alpha_limit, projection):
+    """
+    direct_maps     the maps of equatorial_maps, by projecting every pixel of
+                    the full grid with gore_projection and gore_limits
+    """
+    
+    lam_min, lam_max, phi_min, phi_max = -mt.pi, mt.pi, -mt.pi / 2, mt.pi / 2
+    phi_vector = np.linspace(phi_min, phi_max, h, dtype = np.float32)[:, np.newaxis]
+    gore_width = (lam_max - lam_min) / num_gores
+    gore_index = np.arange(w, dtype = np.float32) // (w / num_gores)
+    lam00 = gore_index * gore_width + gore_width / 2 + lam_min
+    lam_offset = np.linspace(lam_min, lam_max, w) - (gore_index.astype(np.float64) * gore_width + gore_width / 2 + lam_min)
+    lam_offset = lam_offset.astype(np.float32)
+    lam_src, phi_src = gore2.gore_projection(phi_vector, lam_offset, projection)
+    lam_src, phi_src = gore2.gore_limits(lam_src, phi_src, phi_vector, lam_offset, lam00, 
+                                         gore_width, phi_cap, alpha_limit, projection)
+    
+    return (gore2.angle_to_pixels(lam_src, lam_min, lam_max, w), 
+            gore2.angle_to_pixels(phi_src, phi_min, phi_max, h))
+
+
+def covered(x, y, h, w):
+    return (x > -1) & (x < w) & (y > -1) & (y < h)
+
+
+@pytest.mark.parametrize("projection", list(Projection))
+@pytest.mark.parametrize("h, w", [(100, 200), (257, 514), (301, 601), (1001, 2002)])
+@pytest.mark.parametrize("num_gores", [1, 3, 5, 12, 24])
+@pytest.mark.parametrize("alpha_limit", [mt.pi, 1.2])
+def test_band_maps_match_direct_projection(projection, h, w, num_gores, alpha_limit):
+    phi_cap = 0.4
+    x, y = gore2.equatorial_maps(h, w, num_gores, phi_cap = phi_cap, alpha_limit = alpha_limit, 
+                                 projection = projection, rows = (0, h))
+    x_ref, y_ref = direct_maps(h, w, num_gores, phi_cap, alpha_limit, projection)
+    
+    coverage = covered(x, y, h, w)
+    assert np.array_equal(coverage, covered(x_ref, y_ref, h, w))
+    assert np.abs(x - x_ref)[coverage].max(initial = 0) <= TOLERANCE
+    assert np.abs(y - y_ref)[coverage].max(initial = 0) <= TOLERANCE
+
+
+def test_row_ranges_match_whole_maps():
+    h, w = 240, 480
+    x, y = gore2.equatorial_maps(h, w, 6, rows = (0, h))
+    for start, stop in ((0, 1), (17, 90), (100, h)):
+        x_rows, y_rows = gore2.equatorial_maps(h, w, 6, rows = (start, stop))
+        np.testing.assert_allclose(x_rows, x[start:stop], atol = TOLERANCE)
+        np.testing.assert_allclose(y_rows, y[start:stop], atol = TOLERANCE)
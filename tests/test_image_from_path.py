@@ -0,0 +1,33 @@
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+import gore2
+
+
+IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "img", "img1.jpg")
+
+
+@pytest.fixture(autouse = True)
+def no_image_cache(monkeypatch):
+    monkeypatch.setattr(gore2, "image_cache", None)
+
+
+def test_scaled_image_closes_file():
+    with warnings.catch_warnings(record = True) as caught:
+        warnings.simplefilter("always", ResourceWarning)
+        im = gore2.image_from_path(IMAGE, 0.3)
+    assert not [w for w in caught if issubclass(w.category, ResourceWarning)]
+    full = gore2.image_from_path(IMAGE)
+    assert im.shape[:2] == (round(0.3 * full.shape[0]), round(0.3 * full.shape[1]))
+
+
+def test_scaled_image_unknown_to_pil(tmp_path):
+    # PIL cannot identify Radiance HDR images, which OpenCV reads
+    path = str(tmp_path / "fundus.hdr")
+    gore2.cv2.imwrite(path, np.random.RandomState(0).rand(200, 300, 3).astype(np.float32))
+    
+    im = gore2.image_from_path(path, 0.5)
+    assert im.shape == (100, 150, 3)
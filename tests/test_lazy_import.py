@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+
+
+GORE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gore")
+
+
+# the first renders of a fresh interpreter, made from many threads at once, 
+# all of which load the deferred imports together
+FIRST_RENDERS = """
+import sys, threading
+import numpy as np
+import gore2
+
+assert "cv2" not in sys.modules and "PIL.Image" not in sys.modules
+
+im = np.random.RandomState(0).randint(0, 255, (300, 300, 3)).astype(np.uint8)
+barrier = threading.Barrier(16)
+errors = []
+
+def render():
+    barrier.wait()
+    try:
+        gore2.make_rotary_adjusted(None, gore2.deg2rad(40), 6, gore2.deg2rad(10), 0, 20, im = im)
+    except Exception as e:
+        errors.append(repr(e))
+
+threads = [threading.Thread(target = render) for i in range(16)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+print(errors)
+sys.exit(1 if errors else 0)
+"""
+
+
+def test_import_does_not_load_deferred_modules():
+    check = "import sys, gore2; print([name for name in ('cv2', 'PIL.Image', 'scipy.ndimage') if name in sys.modules])"
+    result = subprocess.run([sys.executable, "-c", check], cwd = GORE_DIR, capture_output = True, text = True)
+    assert result.stdout.strip() == "[]", result.stderr
+
+
+def test_first_renders_from_many_threads():
+    for attempt in range(3):
+        result = subprocess.run([sys.executable, "-c", FIRST_RENDERS], cwd = GORE_DIR, capture_output = True, text = True)
+        assert result.returncode == 0, result.stdout + result.stderr
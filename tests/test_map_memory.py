@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+import gore2
+from gore2 import MemoryMeter, Projection
+
+
+# allowance for the vectors of latitude and longitude from which the maps are 
+# built, which grow with the height and width rather than the area (bytes)
+VECTOR_BYTES = 200
+
+
+def peak_bytes_per_pixel(maps, h, w):
+    gore2.map_cache.clear()
+    meter = MemoryMeter()
+    x_src, y_src = maps()
+    peak = meter.stop()
+    gore2.map_cache.clear()
+    
+    assert x_src.shape == y_src.shape == (h, w)
+    return (peak - VECTOR_BYTES * (h + w)) / (h * w)
+
+
+@pytest.mark.parametrize("h, w", [(256, 512), (512, 1024), (1024, 2048), (1500, 1000)])
+def test_equi_maps_peak(h, w):
+    # equi maps are transposed with respect to the fundus image
+    assert peak_bytes_per_pixel(lambda : gore2.equi_maps(w, h, 1.2, rotation = 10), h, w) <= 8
+
+
+@pytest.mark.parametrize("h, w", [(256, 512), (512, 1024), (1024, 2048), (1500, 1000)])
+def test_swap_maps_peak(h, w):
+    assert peak_bytes_per_pixel(lambda : gore2.swap_maps(h, w, 1.2, 1.1), h, w) <= 10
+
+
+@pytest.mark.parametrize("projection, bound", [(Projection.SINUSOIDAL, 13), 
+                                               (Projection.CASSINI, 13), 
+                                               (Projection.ORTHOGRAPHIC, 20)])
+@pytest.mark.parametrize("h, w", [(256, 512), (512, 1024), (1024, 2048)])
+@pytest.mark.parametrize("num_gores", [3, 12])
+def test_equatorial_maps_peak(projection, bound, h, w, num_gores):
+    maps = lambda : gore2.equatorial_maps(h, w, num_gores, phi_cap = 0.4, alpha_limit = 2.0, projection = projection)
+    assert peak_bytes_per_pixel(maps, h, w) <= bound
+
+
+@pytest.mark.parametrize("starter_stops_first", [False, True])
+def test_overlapping_meters(starter_stops_first):
+    import tracemalloc
+    
+    assert not tracemalloc.is_tracing()
+    starter = MemoryMeter()
+    other = MemoryMeter()
+    first, last = (starter, other) if starter_stops_first else (other, starter)
+    first.stop()
+    
+    # whichever meter stops first, tracing stays on for the one still running
+    assert tracemalloc.is_tracing()
+    block = np.ones(1 << 20, np.uint8)
+    del block
+    assert last.stop() >= 1 << 20
+    assert not tracemalloc.is_tracing()
+
+
+def test_meters_leave_tracing_they_did_not_start():
+    import tracemalloc
+    
+    tracemalloc.start()
+    try:
+        first = MemoryMeter()
+        second = MemoryMeter()
+        first.stop()
+        second.stop()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
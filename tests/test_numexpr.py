@@ -0,0 +1,66 @@
+import importlib.util
+
+import numpy as np
+import pytest
+
+import gore2
+from gore2 import Projection
+
+
+# float32 rounding of the angles (radians), which numexpr and numpy may round
+# differently
+TOLERANCE = 2e-5
+
+
+@pytest.fixture
+def backend():
+    yield
+    gore2.use_numexpr(False)
+
+
+def both_backends(inverse, *args):
+    gore2.use_numexpr(False)
+    expected = inverse(*args)
+    assert gore2.use_numexpr()
+    return expected, inverse(*args)
+
+
+@pytest.mark.parametrize("projection", list(Projection))
+@pytest.mark.parametrize("num_gores", [3, 12])
+def test_gore_projection_matches_numpy(backend, projection, num_gores):
+    pytest.importorskip("numexpr")
+    
+    phi_dst = np.linspace(-np.pi / 2, np.pi / 2, 301, dtype = np.float32)[:, np.newaxis]
+    lam_offset = np.linspace(-np.pi / num_gores, np.pi / num_gores, 257, dtype = np.float32)
+    expected, fused = both_backends(gore2.gore_projection, phi_dst, lam_offset, projection)
+    
+    for numpy_map, numexpr_map in zip(expected, fused):
+        assert numexpr_map.dtype == numpy_map.dtype == np.float32
+        assert numexpr_map.shape == numpy_map.shape
+        np.testing.assert_allclose(numexpr_map, numpy_map, rtol = TOLERANCE, atol = TOLERANCE)
+
+
+def test_swap_inverse_matches_numpy(backend):
+    pytest.importorskip("numexpr")
+    
+    phi_dst = np.linspace(-np.pi / 2, np.pi / 2, 301, dtype = np.float32)[:, np.newaxis]
+    lam_dst = np.linspace(0, 2 * np.pi, 257, dtype = np.float32)
+    expected, fused = both_backends(gore2.swap_inverse, phi_dst, lam_dst)
+    
+    for numpy_map, numexpr_map in zip(expected, fused):
+        assert numexpr_map.dtype == numpy_map.dtype == np.float32
+        assert numexpr_map.shape == numpy_map.shape
+        np.testing.assert_allclose(numexpr_map, numpy_map, rtol = TOLERANCE, atol = TOLERANCE)
+
+
+def test_numpy_kept_without_numexpr(backend, monkeypatch):
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, "find_spec", 
+                        lambda name, *args : None if name == "numexpr" else find_spec(name, *args))
+    
+    assert gore2.use_numexpr() is False
+    assert gore2.numexpr is None
+    
+    # the maps are still made, by numpy
+    lam_src, phi_src = gore2.gore_projection(np.float32([[0.5]]), np.float32([0.1]), Projection.CASSINI)
+    assert np.isfinite(lam_src).all() and np.isfinite(phi_src).all()
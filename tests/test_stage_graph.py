@@ -0,0 +1,100 @@
+import gc
+
+import numpy as np
+import pytest
+
+import gore2
+
+
+ARGS = dict(image_path = None, alpha_max = gore2.deg2rad(40), num_gores = 12, phi_no_cut = gore2.deg2rad(10), 
+            rotation = 0, quality = 30)
+
+
+@pytest.fixture
+def fundus():
+    return np.random.RandomState(0).randint(0, 255, (400, 380, 3)).astype(np.uint8)
+
+
+def test_image_changed_in_place(fundus):
+    graph = gore2.StageGraph()
+    first = np.asarray(graph.run(**ARGS, im = fundus))
+    
+    fundus[100:300, 100:300] = 255 - fundus[100:300, 100:300]
+    second = np.asarray(graph.run(**ARGS, im = fundus))
+    
+    assert "deres" in graph.computed
+    assert np.array_equal(second, np.asarray(gore2.make_rotary_adjusted(**ARGS, im = fundus)))
+    assert not np.array_equal(first, second)
+
+
+def test_new_image_never_reuses_results(fundus):
+    graph = gore2.StageGraph()
+    for seed in range(4):
+        im = np.random.RandomState(seed).randint(0, 255, fundus.shape).astype(np.uint8)
+        output = np.asarray(graph.run(**ARGS, im = im))
+        assert "deres" in graph.computed
+        assert np.array_equal(output, np.asarray(gore2.make_rotary_adjusted(**ARGS, im = im)))
+        del im
+        gc.collect()
+
+
+@pytest.mark.parametrize("mode", list(gore2.Mode))
+def test_output_matches_make_rotary_adjusted(fundus, mode):
+    graph = gore2.StageGraph()
+    for num_gores in (12, 7):
+        args = dict(ARGS, num_gores = num_gores, mode = mode, tile_memory = 1 << 20)
+        assert np.array_equal(np.asarray(graph.run(**args, im = fundus)), 
+                              np.asarray(gore2.make_rotary_adjusted(**args, im = fundus)))
+
+
+def test_output_from_path_matches_make_rotary_adjusted(monkeypatch):
+    monkeypatch.setattr(gore2, "image_cache", None)
+    path = gore2.os.path.join(gore2.os.path.dirname(gore2.os.path.dirname(gore2.__file__)), "img", "img1.jpg")
+    args = dict(ARGS, image_path = path)
+    graph = gore2.StageGraph()
+    assert np.array_equal(np.asarray(graph.run(**args)), np.asarray(gore2.make_rotary_adjusted(**args)))
+    assert graph.computed == ["load", "background", "equi", "swap", "polar", "polecap", "composite"]
+
+
+@pytest.mark.parametrize("change, recomputed", [(dict(num_gores = 8), ["polar", "polecap", "composite"]), 
+                                                (dict(phi_no_cut = gore2.deg2rad(15)), ["polecap", "composite"]),
+                                                (dict(projection = gore2.Projection.SINUSOIDAL), ["polar", "composite"]),
+                                                (dict(rotation = 10), ["equi", "swap", "polar", "polecap", "composite"]),
+                                                (dict(), [])])
+def test_only_changed_stages_recomputed(fundus, change, recomputed):
+    graph = gore2.StageGraph()
+    graph.run(**ARGS, im = fundus)
+    assert graph.computed == ["load", "deres", "background", "equi", "swap", "polar", "polecap", "composite"]
+    
+    output = graph.run(**dict(ARGS, **change), im = fundus)
+    assert graph.computed == recomputed
+    assert np.array_equal(np.asarray(output), np.asarray(gore2.make_rotary_adjusted(**dict(ARGS, **change), im = fundus)))
+
+
+def test_cancelled_run_resumes(fundus):
+    graph = gore2.StageGraph()
+    token = gore2.CancelToken()
+    
+    # cancel as the polar stage starts, once equi and swap have completed
+    def progress(stage):
+        if stage == gore2.Progress.POLAR.value:
+            token.cancel()
+    
+    assert graph.run(**ARGS, im = fundus, progress = progress, cancel = token) is None
+    assert graph.computed == ["load", "deres", "background", "equi", "swap"]
+    
+    output = graph.run(**ARGS, im = fundus)
+    assert graph.computed == ["polar", "polecap", "composite"]
+    assert np.array_equal(np.asarray(output), np.asarray(gore2.make_rotary_adjusted(**ARGS, im = fundus)))
+
+
+@pytest.mark.parametrize("mode", list(gore2.Mode))
+def test_run_array_returns_net_without_copy(fundus, mode):
+    graph = gore2.StageGraph()
+    args = dict(ARGS, mode = mode)
+    rotary = graph.run_array(**args, im = fundus)
+    
+    assert isinstance(rotary, np.ndarray) and rotary.shape[2] == 4
+    assert np.array_equal(rotary, np.asarray(graph.run(**args, im = fundus)))
+    if mode != gore2.Mode.COMPOSITE:
+        assert rotary is graph.results["composite"][1]
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+import gore2
+
+
+def direct_maps(h, w, phi_extent, lam_extent, rows = None):
+    """
+    direct_maps     the maps of swap_maps, by evaluating swap_longitude and
+                    swap_latitude at every pixel, without the reflection of 
+                    the y map in the equator
+    """
+    
+    start, stop = rows or (0, h)
+    phi_vector = np.linspace(-np.pi / 2, np.pi / 2, h, dtype = np.float32)[start:stop, np.newaxis]
+    lam_vector = np.linspace(0, 2 * np.pi, w, dtype = np.float32)
+    lam_src = gore2.swap_longitude(phi_vector, lam_vector)
+    phi_src = gore2.swap_latitude(phi_vector, lam_vector)
+    
+    return (gore2.angle_to_pixels(lam_src, -lam_extent, lam_extent, w), 
+            gore2.angle_to_pixels(phi_src, -phi_extent, phi_extent, h))
+
+
+SIZES = [(1, 1), (2, 3), (3, 2), (5, 7), (17, 4), (64, 129), (257, 96), (2935, 40)]
+
+
+@pytest.mark.parametrize("h, w", SIZES)
+def test_whole_maps_match_direct(h, w):
+    gore2.map_cache.clear()
+    x_src, y_src = gore2.swap_maps(h, w, 1.2, 1.1)
+    x_direct, y_direct = direct_maps(h, w, 1.2, 1.1)
+    gore2.map_cache.clear()
+    
+    assert x_src.dtype == x_direct.dtype and y_src.dtype == y_direct.dtype
+    assert np.array_equal(x_src, x_direct)
+    assert np.array_equal(y_src, y_direct)
+
+
+@pytest.mark.parametrize("h, w", SIZES)
+def test_row_bands_match_direct(h, w):
+    # bands above, across and below the equator, and single rows at the edges
+    bands = {(0, h), (0, 1), (h - 1, h), (0, (h + 1) // 2), (h // 3, h - h // 3), (h // 2, h), (h // 4, h // 2 + 1)}
+    for rows in sorted(band for band in bands if band[0] < band[1]):
+        x_src, y_src = gore2.swap_maps(h, w, 0.9, 1.3, rows = rows)
+        x_direct, y_direct = direct_maps(h, w, 0.9, 1.3, rows)
+        assert np.array_equal(x_src, x_direct), rows
+        assert np.array_equal(y_src, y_direct), rows